@@ -0,0 +1,395 @@
+"""Offline benchmark of video_loopback without a webui or a GPU.
+
+The webui modules (processing, shared, images, scripts), gradio and the
+MasaCtrl controller are replaced by stand-ins, and ``process_images`` returns
+copies of its init image, so what is measured is the extension's own work:
+decoding, blending, masks, saving, video encoding and post processing.
+Every configuration of the sweep runs ``Script.run`` end to end on synthetic
+frames in its own subprocess, and reports frames/s and peak RSS.
+
+Needs the extension's own dependencies (torch, numpy, Pillow, ...) and
+ffmpeg on PATH. Run from the repository root:
+
+    python benchmarks/bench_video_loopback.py --frames 24 --windows 1,5 --references 0,1
+"""
+import argparse
+import inspect
+import itertools
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from enum import Enum
+from pathlib import Path
+from unittest import mock
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RESULT_PREFIX = 'BENCH_RESULT '
+
+# arguments of Script.run, as the UI defaults them
+DEFAULT_ARGS = {
+    'input_dir': '',
+    'output_dir': '',
+    'use_mask': False,
+    'mask_dir': '',
+    'mask_threshold': 127,
+    'read_prompt_from_txt': False,
+    'output_frame_rate': 30,
+    'max_frames': 9999,
+    'extract_nth_frame': 1,
+    'is_continuous': False,
+    'loop_n': 10,
+    'superimpose_alpha': 0.25,
+    'fix_seed': True,
+    'fix_subseed': False,
+    'temporal_superimpose_method': 'simple',
+    'temporal_superimpose_alpha_list': '1',
+    'reference_frames_dir': '',
+    'save_every_loop': True,
+    'masa_control_use_index': False,
+    # MasaCtrl is stubbed out, its ranges are not benchmarked
+    'masa_control_active_range': '',
+    'subseed_strength_schedule': '',
+    'denoising_schedule': '',
+    'step_schedule': '',
+    'seed_schedule': '',
+    'subseed_schedule': '',
+    'cfg_schedule': '',
+    'superimpose_alpha_schedule': '',
+    'temporal_superimpose_schedule': '',
+    'prompt_schedule': '',
+    'negative_prompt_schedule': '',
+    'batch_count_schedule': '',
+    'image_post_processing_schedule': '',
+    'video_post_process_method': 'None',
+    'video_post_process_alpha': 0.3,
+    'fastdvdnet_noise_sigma': 60,
+    'stream_input_video': False,
+    'frame_store_budget_mb': 2048,
+    'prefetch_frames': 4,
+    'decoded_frame_cache_mb': 1024,
+    'blend_engine': 'numpy',
+    'fastdvdnet_chunk_size': 32,
+    'fastdvdnet_cpu_threads': 0,
+    'fastdvdnet_batch_size': 4,
+    'fastdvdnet_fused': True,
+    'fastdvdnet_tile_size': 0,
+    'fastdvdnet_tile_overlap': 32,
+    'fastdvdnet_precision': 'fp32',
+    'resume_run_dir': '',
+    'record_timings': True,
+    'shard_role': 'off',
+    'shard_queue_dir': '',
+    'shard_size': 16,
+}
+
+
+# ---------------------------------------------------------------- stand-ins
+
+class StubProcessing:
+    """The attributes of StableDiffusionProcessingImg2Img that run() uses."""
+
+    def __init__(self, width, height, n_iter=1, batch_size=1):
+        self.seed = -1
+        self.subseed = -1
+        self.subseed_strength = 0.0
+        self.cfg_scale = 7.0
+        self.prompt = 'benchmark'
+        self.negative_prompt = ''
+        self.sampler_name = 'stub'
+        self.width = width
+        self.height = height
+        self.denoising_strength = 0.5
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+        self.steps = 20
+        self.resize_mode = 0
+        self.script_args = ()
+        self.init_images = []
+        self.image_mask = None
+
+
+class StubProcessed:
+    def __init__(self, p, images_list, seed=-1, info='', subseed=None):
+        self.images = images_list
+        self.seed = seed
+        self.subseed = subseed
+        self.info = info
+
+
+def fix_seed(p):
+    if p.seed is None or p.seed == -1:
+        p.seed = random.randrange(2**32)
+    if p.subseed is None or p.subseed == -1:
+        p.subseed = random.randrange(2**32)
+
+
+def process_images(p):
+    # the generated images are copies of the init image, at the size SD would return
+    init_image = p.init_images[0]
+    images_list = [init_image.copy() for _ in range(p.n_iter * p.batch_size)]
+    return StubProcessed(p, images_list, p.seed, '', p.subseed)
+
+
+def resize_image(resize_mode, im, width, height):
+    from PIL import Image
+    if im.size == (width, height):
+        return im
+    return im.resize((width, height), Image.LANCZOS)
+
+
+class StubState:
+    interrupted = False
+    job_count = 0
+
+    def begin(self):
+        self.interrupted = False
+
+    def end(self):
+        pass
+
+
+def install_stubs():
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    processing = module(
+        'modules.processing', fix_seed=fix_seed,
+        process_images=process_images, Processed=StubProcessed)
+    shared = module(
+        'modules.shared',
+        opts=types.SimpleNamespace(CLIP_stop_at_last_layers=1),
+        sd_model=types.SimpleNamespace(
+            sd_checkpoint_info=types.SimpleNamespace(model_name='stub'),
+            sd_model_hash='00000000'),
+        state=StubState(),
+        masa_controller=types.SimpleNamespace(calculate_reconstruction_maps=lambda: None))
+    images = module('modules.images', resize_image=resize_image)
+    scripts = module(
+        'modules.scripts', Script=type('Script', (), {}),
+        scripts_img2img=types.SimpleNamespace(scripts=[]),
+        scripts_txt2img=types.SimpleNamespace(alwayson_scripts=[]))
+    module('modules', processing=processing, shared=shared, images=images, scripts=scripts)
+
+    controller = module(
+        'extensions.sd_webui_masactrl.scripts.masactrl_controller',
+        MasaControllerMode=Enum('MasaControllerMode', 'IDLE LOGGING LOGRECON'))
+    masactrl_scripts = module(
+        'extensions.sd_webui_masactrl.scripts', masactrl_controller=controller)
+    masactrl = module('extensions.sd_webui_masactrl', scripts=masactrl_scripts)
+    module('extensions', sd_webui_masactrl=masactrl)
+
+    # only ui() touches gradio
+    sys.modules['gradio'] = mock.MagicMock()
+
+
+# ---------------------------------------------------------------- synthetic data
+
+def make_frames(frames_dir: Path, frame_n, size, seed=0, mask=False, first_index=1):
+    """Moving shapes over a gradient with noise, or masks of the shapes."""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    frames_dir.mkdir(parents=True, exist_ok=True)
+    width, height = size
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    for i in range(frame_n):
+        if mask:
+            img = Image.new('L', size, 0)
+        else:
+            arr = gradient * np.ones((height, 1, 3), np.float32) \
+                + rng.normal(0, 8, (height, width, 3))
+            img = Image.fromarray(arr.clip(0, 255).astype(np.uint8))
+        draw = ImageDraw.Draw(img)
+        x = (i * width // max(frame_n, 1)) % width
+        box = (x, height // 4, x + width // 4, height // 4 + height // 3)
+        draw.ellipse(box, fill=255 if mask else (200, 40 + seed * 30, 90))
+        img.save(frames_dir / f'{i + first_index:07d}.png')
+
+
+def prepare_data(workdir: Path, frame_n, size, reference_n) -> dict:
+    name = f'{size[0]}x{size[1]}_{frame_n}'
+    data = {
+        'input_dir': workdir / f'input_{name}',
+        'mask_dir': workdir / f'mask_{name}',
+        'reference_dirs': [workdir / f'reference_{i}_{name}' for i in range(reference_n)],
+    }
+    if not data['input_dir'].is_dir():
+        make_frames(data['input_dir'], frame_n, size)
+    if not data['mask_dir'].is_dir():
+        # masks are matched by name, and the output frames of a loop start at 0000000.png
+        make_frames(data['mask_dir'], frame_n + 1, size, mask=True, first_index=0)
+    for i, reference_dir in enumerate(data['reference_dirs']):
+        if not reference_dir.is_dir():
+            make_frames(reference_dir, frame_n, size, seed=i + 1)
+    return data
+
+
+# ---------------------------------------------------------------- running
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2**20
+        except (ImportError, AttributeError):
+            return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def run_args(config: dict, data: dict, output_dir: Path) -> dict:
+    from scripts.video_loopback import Script
+
+    overrides = {
+        'input_dir': str(data['input_dir']),
+        'output_dir': str(output_dir),
+        'loop_n': config['loops'],
+        'use_mask': bool(config['mask']),
+        'mask_dir': str(data['mask_dir']) if config['mask'] else '',
+        'temporal_superimpose_alpha_list': ','.join(['1'] * config['window']),
+        'reference_frames_dir': '!!!'.join(str(p) for p in data['reference_dirs']),
+        'video_post_process_method': config['post_process'],
+        'temporal_superimpose_method': config['temporal_method'],
+    }
+    args = {}
+    for name in list(inspect.signature(Script.run).parameters)[2:]:
+        if name.startswith('_'):
+            continue
+        if name not in DEFAULT_ARGS:
+            raise KeyError(f'Script.run takes "{name}", add its UI default to DEFAULT_ARGS')
+        args[name] = overrides.get(name, DEFAULT_ARGS[name])
+    return args
+
+
+def run_one(config: dict, workdir: Path) -> dict:
+    """Runs a configuration in this process, called in a subprocess by sweep()."""
+    sys.path.insert(0, str(REPO_ROOT))
+    install_stubs()
+    size = tuple(config['size'])
+    data = prepare_data(workdir, config['frames'], size, config['references'])
+
+    from scripts.video_loopback import Script
+    from scripts.video_loopback_utils import timings
+    import_rss = peak_rss_mb()
+
+    output_dir = Path(tempfile.mkdtemp(prefix='run_', dir=workdir))
+    p = StubProcessing(*size, n_iter=config['batch_count'])
+    args = run_args(config, data, output_dir)
+    start = time.perf_counter()
+    Script().run(p, **args)
+    elapsed = time.perf_counter() - start
+    stages = {}
+    for loop in timings.timer.to_json()['loops']:
+        for kind in ('per_frame', 'loop'):
+            for name, summary in loop[kind].items():
+                stages[name] = stages.get(name, 0.0) + summary['total']
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    frame_n = config['frames'] * config['loops']
+    return {
+        'config': config,
+        'seconds': elapsed,
+        'frames_per_second': frame_n / elapsed,
+        'import_rss_mb': import_rss,
+        'peak_rss_mb': peak_rss_mb(),
+        'stage_seconds': stages,
+    }
+
+
+def sweep(args) -> list:
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='video_loopback_bench_'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    configs = [
+        {
+            'size': size, 'window': window, 'batch_count': batch_count,
+            'mask': mask, 'references': references,
+            'frames': args.frames, 'loops': args.loops, 'post_process': args.post_process,
+            'temporal_method': args.temporal_method,
+        }
+        for size, window, batch_count, mask, references in itertools.product(
+            args.resolutions, args.windows, args.batch_counts, args.masks, args.references)
+    ]
+
+    results = []
+    header = f'{"size":>10} {"window":>6} {"batch":>5} {"mask":>4} {"refs":>4} ' \
+             f'{"frames/s":>9} {"peak MB":>8} {"import MB":>9}'
+    print(header)
+    for config in configs:
+        proc = subprocess.run(
+            [sys.executable, __file__, '--run-one', json.dumps(config), '--workdir', str(workdir)],
+            capture_output=True, text=True, cwd=REPO_ROOT)
+        lines = [l for l in proc.stdout.splitlines() if l.startswith(RESULT_PREFIX)]
+        size = f'{config["size"][0]}x{config["size"][1]}'
+        row = f'{size:>10} {config["window"]:>6} {config["batch_count"]:>5} ' \
+              f'{config["mask"]:>4} {config["references"]:>4} '
+        if proc.returncode != 0 or not lines:
+            print(row + 'failed')
+            print(proc.stderr[-2000:])
+            results.append({'config': config, 'error': proc.stderr[-2000:]})
+            continue
+        result = json.loads(lines[-1][len(RESULT_PREFIX):])
+        results.append(result)
+
+        def mb(v):
+            return f'{v:.0f}' if v is not None else '-'
+        print(row + f'{result["frames_per_second"]:>9.2f} '
+                    f'{mb(result["peak_rss_mb"]):>8} {mb(result["import_rss_mb"]):>9}')
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def int_list(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+def size_list(text):
+    return [tuple(int(v) for v in x.split('x')) for x in text.split(',') if x]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark video_loopback with a stubbed SD backend')
+    parser.add_argument('--frames', type=int, default=24, help='frames per sequence')
+    parser.add_argument('--loops', type=int, default=2)
+    parser.add_argument('--resolutions', type=size_list, default=[(512, 512), (1024, 576)])
+    parser.add_argument('--windows', type=int_list, default=[1, 3, 5],
+                        help='temporal window sizes, odd')
+    parser.add_argument('--batch-counts', type=int_list, default=[1, 2])
+    parser.add_argument('--masks', type=int_list, default=[0, 1], help='0 without mask, 1 with')
+    parser.add_argument('--references', type=int_list, default=[0, 1, 2],
+                        help='numbers of reference directories')
+    parser.add_argument('--post-process', type=str, default='None',
+                        choices=['None', 'FastDVDNet', 'FastDVDNet (CPU)'])
+    parser.add_argument('--temporal-method', type=str, default='simple',
+                        choices=['simple', 'with difference mask from reference'])
+    parser.add_argument('--workdir', type=str, default='',
+                        help='where synthetic frames are generated, kept between runs if given')
+    parser.add_argument('--output', type=str, default=str(REPO_ROOT / 'bench_output.txt'),
+                        help='JSON results of every configuration')
+    parser.add_argument('--run-one', type=str, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(RESULT_PREFIX + json.dumps(run_one(json.loads(args.run_one), Path(args.workdir))))
+        sys.exit(0)
+
+    if shutil.which('ffmpeg') is None:
+        sys.exit('ffmpeg is needed to encode the videos, it is not on PATH')
+    results = sweep(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f'results written to {args.output}')
@@ -4,33 +4,55 @@ import time
 from modules import processing, shared
 from modules.processing import Processed
 
-import os, math, json
+import os, math, json, shutil, traceback
 from PIL import Image, ImageChops, ImageFilter
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Tuple, Iterable
 
 from modules import scripts
 
-from scripts.video_loopback_utils import utils
+from scripts.video_loopback_utils import utils, timings
 from scripts.video_loopback_utils.utils import \
     resize_img, make_video, is_image, get_image_paths, \
-    get_prompt_for_images, blend_average, get_now_time
-from scripts.video_loopback_utils.fastdvdnet_processor import FastDVDNet
+    get_prompt_for_images, blend_average, get_now_time, save_image_atomic
+from scripts.video_loopback_utils.fastdvdnet_processor import \
+    get_fastdvdnet, unload_fastdvdnet
+from scripts.video_loopback_utils.video_io import FFmpegFrameReader, FFmpegVideoWriter
+from scripts.video_loopback_utils.frame_store import FrameStore
+from scripts.video_loopback_utils.frame_saver import AsyncFrameSaver
+from scripts.video_loopback_utils.frame_prefetcher import FramePrefetcher
+from scripts.video_loopback_utils.frame_cache import decoded_frame_cache
+from scripts.video_loopback_utils.masks import MaskProvider
+from scripts.video_loopback_utils.schedules import ScheduleTable
+from scripts.video_loopback_utils.resume import RunResume, LOOP_COMPLETE, post_process_once
+from scripts.video_loopback_utils.masactrl_plan import MasaCtrlRangePlan
+from scripts.video_loopback_utils.sharding import \
+    SHARD_ROLES, POLL_SECONDS, ShardQueue, split_range
+from scripts.video_loopback_utils.blending import \
+    blend_weighted, blend_difference_masked, DifferenceMaskCache
 
 from extensions.sd_webui_masactrl.scripts.masactrl_controller import MasaControllerMode
 
 
 
-def update_script_args(p, value, arg_idx, script_class):
+def find_masactrl_script():
+    # the alwayson instance holds the args_from of the MasaCtrl arguments
+    masactrl_ui_script = next(
+        (v for v in scripts.scripts_img2img.scripts if str(v).startswith('<masactrl_ui.py.Script')), None)
+    if masactrl_ui_script is None:
+        return None
+    return next(
+        (s for s in scripts.scripts_txt2img.alwayson_scripts
+         if isinstance(s, masactrl_ui_script.__class__)), None)
 
-    for s in scripts.scripts_txt2img.alwayson_scripts:
-        if isinstance(s, script_class):
-            args = list(p.script_args)
-            # print(f"Changed arg {arg_idx} from {args[s.args_from + arg_idx - 1]} to {value}")
-            args[s.args_from + arg_idx] = value
-            p.script_args = tuple(args)
-            break
+
+def update_script_args(p, value, arg_idx, script):
+    args = list(p.script_args)
+    # print(f"Changed arg {arg_idx} from {args[script.args_from + arg_idx - 1]} to {value}")
+    args[script.args_from + arg_idx] = value
+    p.script_args = tuple(args)
 def gr_show(visible=True):
     return {"visible": visible, "__type__": "update"}
 
@@ -40,14 +62,29 @@ class TemporalImageBlender:
             self, image_path_list=None, window_size=1,
             target_size=(512, 512),
             use_mask=False,
-            mask_dir='', mask_threshold=127):
+            mask_dir='', mask_threshold=127,
+            frame_saver=None,
+            prefetch_executor=None, prefetch_depth=0,
+            frame_cache=None, mask_provider=None):
         self.image_path_list = image_path_list
+        # frame sources that are not plain files provide their own reader
+        self.image_reader = getattr(image_path_list, 'open_image', Image.open)
         self.target_size = target_size
+        self.frame_cache = frame_cache
+
+        # decode the upcoming frames in the background while SD is running
+        self.prefetcher = None
+        if prefetch_executor is not None and prefetch_depth > 0:
+            self.prefetcher = FramePrefetcher(
+                lambda i: self.read_image_resize(self.image_path_list[i]),
+                frame_n=len(image_path_list),
+                executor=prefetch_executor, depth=prefetch_depth
+            )
 
         assert window_size % 2 == 1
         self.window_size = window_size
         self.window = deque(
-            self.read_image_resize(image_path_list[i])
+            self.read_frame(i)
             for i in range(window_size // 2 + 1)
         )
         self.current_i = 0
@@ -56,9 +93,27 @@ class TemporalImageBlender:
         self.use_mask = use_mask
         self.mask_dir = Path(mask_dir) if mask_dir else None
         self.mask_threshold = mask_threshold
+        if use_mask and mask_provider is None:
+            mask_provider = MaskProvider(mask_dir, mask_threshold, target_size)
+        self.mask_provider = mask_provider
+        self._current_mask = None  # (current_i, mask)
+        # 同一对参考帧会出现在相邻的多个窗口中
+        self.diff_mask_cache = DifferenceMaskCache(max_size=window_size * window_size)
+        self.frame_saver = frame_saver
 
     def read_image_resize(self, path) -> Image.Image:
-        return resize_img(Image.open(path), self.target_size)
+        with timings.timer.stage('decode'):
+            if self.frame_cache is not None:
+                return self.frame_cache.get(
+                    path, self.target_size,
+                    lambda: resize_img(self.image_reader(path), self.target_size)
+                )
+            return resize_img(self.image_reader(path), self.target_size)
+
+    def read_frame(self, i) -> Image.Image:
+        if self.prefetcher is not None:
+            return self.prefetcher.get(i)
+        return self.read_image_resize(self.image_path_list[i])
 
     def move_to_next(self):
         hws = self.window_size // 2  # half window size
@@ -67,17 +122,35 @@ class TemporalImageBlender:
             self.current_i = len(self.image_path_list) - 1
             return
         if self.current_i + hws < len(self.image_path_list):
-            self.window.append(self.read_image_resize(
-                self.image_path_list[self.current_i + hws]))
+            self.window.append(self.read_frame(self.current_i + hws))
         if self.current_i - hws > 0:
             self.window.popleft()
         else:
             self.current_pos += 1
         assert self.current_pos < len(self.window) <= self.window_size
 
+    def seek(self, i):
+        """Moves to frame i, reading only the frames of its window."""
+        hws = self.window_size // 2  # half window size
+        frame_n = len(self.image_path_list)
+        i = min(max(i, 0), frame_n - 1)
+        self._current_mask = None
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        self.window = deque(
+            self.read_frame(j)
+            for j in range(max(i - hws, 0), min(i + hws + 1, frame_n))
+        )
+        self.current_i = i
+        self.current_pos = i - max(i - hws, 0)
+
     def reset(self):
+        self._current_mask = None
+        self.diff_mask_cache.clear()
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
         self.window = deque(
-            self.read_image_resize(self.image_path_list[i])
+            self.read_frame(i)
             for i in range(self.window_size // 2 + 1)
         )
         self.current_i = 0
@@ -89,40 +162,22 @@ class TemporalImageBlender:
     def current_mask(self):
         if not self.use_mask:
             return None
-        mask = None
+        # 每帧只计算一次
+        if self._current_mask is not None and self._current_mask[0] == self.current_i:
+            return self._current_mask[1]
         if self.mask_dir:
-            if self.mask_dir.is_dir():
-                mask_name = self.image_path_list[self.current_i].name
-                mask_path = self.mask_dir/mask_name
-                if mask_path.is_file():
-                    mask = Image.open(mask_path).convert('L')
-                else:
-                    print(f'Warning: "{mask_path}" has no mask')
-            elif self.mask_dir.is_file():
-                mask = Image.open(self.mask_dir).convert('L')
-            else:
-                raise FileNotFoundError("mask not found")
+            mask = self.mask_provider.file_mask(
+                self.image_path_list[self.current_i].name)
         else:
-            if 'RGBA' == self.current_image().mode:
-                mask = self.current_image().split()[-1]
-            else:
-                print('current image mode: ', self.current_image().mode)
-                print(f'Warning: "{self.image_path_list[self.current_i]}" has no alpha mask')
-        # apply threshold
-        if mask is not None:
-            mask = mask.convert('L').point(
-                lambda x: 255 if x > self.mask_threshold else 0)
-
-            # resize mask
-            if mask.size != self.target_size:
-                mask = resize_img(mask, self.target_size)
-
+            mask = self.mask_provider.alpha_mask(
+                self.current_image(), self.image_path_list[self.current_i])
+        self._current_mask = (self.current_i, mask)
         return mask
 
     def blend_batch(self, new_imgs: Iterable[Image.Image],
                     superimpose_alpha, mask=None):
         if not new_imgs:
-            return self.current_image()
+            return self.current_image().copy()  # 窗口中的图片可能被缓存共享
 
         new_img: Image.Image = blend_average(new_imgs)
         base_img = self.current_image().convert(new_img.mode)
@@ -140,16 +195,20 @@ class TemporalImageBlender:
         if len(alpha_list) != self.window_size:
             raise ValueError('the length of temporal_superimpose_alpha_list must be fixed')
         hws = self.window_size // 2  # half window size
-        now_fac_sum = 0.0
-        output_img = self.window[0]
-        for factor, img in zip(
-                alpha_list[-(self.current_i + hws + 1):],
-                self.window):
-            now_fac_sum += factor
-            if now_fac_sum <= 0:
-                continue
-            img = img.convert(output_img.mode)
-            output_img = Image.blend(output_img, img, factor / now_fac_sum)
+        if 'numpy' == utils.blend_engine:
+            output_img = blend_weighted(
+                self.window, alpha_list[-(self.current_i + hws + 1):])
+        else:
+            now_fac_sum = 0.0
+            output_img = self.window[0]
+            for factor, img in zip(
+                    alpha_list[-(self.current_i + hws + 1):],
+                    self.window):
+                now_fac_sum += factor
+                if now_fac_sum <= 0:
+                    continue
+                img = img.convert(output_img.mode)
+                output_img = Image.blend(output_img, img, factor / now_fac_sum)
 
         if mask is None:
             mask = self.current_mask()
@@ -163,22 +222,30 @@ class TemporalImageBlender:
         if len(alpha_list) != self.window_size:
             raise ValueError('the length of temporal_superimpose_alpha_list must be fixed')
         hws = self.window_size // 2  # half window size
-        output_img = blend_average(
-            Image.composite(
-                self.current_image(), img,
-                mask=ImageChops.difference(
-                    reference_img_list[self.current_pos],
-                    origin_img
-                ).convert('L').point(
-                    lambda x: 255 if x > 0 else 255*(1-alpha)
-                ).resize(img.size,  Image.ANTIALIAS)
-            )
-            for alpha, img, origin_img in zip(
+        if 'numpy' == utils.blend_engine:
+            output_img = blend_difference_masked(
+                self.current_image(), list(self.window),
                 alpha_list[-(self.current_i + hws + 1):],
-                self.window,
-                reference_img_list
+                reference_img_list[self.current_pos], list(reference_img_list),
+                self.diff_mask_cache
+            )
+        else:
+            output_img = blend_average(
+                Image.composite(
+                    self.current_image(), img,
+                    mask=ImageChops.difference(
+                        reference_img_list[self.current_pos],
+                        origin_img
+                    ).convert('L').point(
+                        lambda x: 255 if x > 0 else 255*(1-alpha)
+                    ).resize(img.size, Image.LANCZOS)
+                )
+                for alpha, img, origin_img in zip(
+                    alpha_list[-(self.current_i + hws + 1):],
+                    self.window,
+                    reference_img_list
+                )
             )
-        )
 
         if mask is None:
             mask = self.current_mask()
@@ -189,21 +256,13 @@ class TemporalImageBlender:
         return output_img
 
     def save_current_output_image(self, path, img: Image.Image):
-        max_retries = 3
-        retry_interval = 5  # seconds
-        for i in range(max_retries):
-            try:
-                if self.use_mask and not self.mask_dir:
-                    img.putalpha(self.current_mask())
-                img.save(path)
-                break 
-            except (OSError, FileNotFoundError) as e:
-                # Transport endpoint is not connected or FileNotFoundError
-                print(f"Exception occurred: {type(e).__name__} - {str(e)}")
-                if i < max_retries - 1:  # wait for a while unless this is the last try
-                    time.sleep(retry_interval)
-                else:
-                    raise 
+        if self.use_mask and not self.mask_dir:
+            img.putalpha(self.current_mask())
+        if self.frame_saver is not None:
+            # 异步保存, 错误在frame_saver.flush()时抛出
+            self.frame_saver.submit(img, path)
+        else:
+            save_image_atomic(img, path)
 
 class Script(modules.scripts.Script):
     def title(self):
@@ -217,7 +276,17 @@ class Script(modules.scripts.Script):
             label='input_directory',
             placeholder='A directory or a file'
         )
+        stream_input_video = gr.Checkbox(
+            label='stream_input_video (decode a video input through a pipe instead of extracting frames)',
+            value=False
+        )
         output_dir = gr.Textbox(label='output_directory')
+        resume_run_dir = gr.Textbox(
+            label='resume_run_directory',
+            value='',
+            placeholder='Keep this empty to start a new run. '
+                        'A run directory continues that run with its own settings'
+        )
         # mask settings
         use_mask = gr.Checkbox(label='use_mask(inpainting)', value=False)
         with gr.Box(visible=False) as mask_settings_box:
@@ -262,6 +331,34 @@ class Script(modules.scripts.Script):
                         'Split you paths with "!!!" if you are using multi-Controlnet. '
         )
         save_every_loop = gr.Checkbox(label='save_every_loop', value=True)
+        prefetch_frames = gr.Number(
+            label='prefetch_frames (frames decoded ahead in the background, 0 to disable)',
+            precision=0, value=4
+        )
+        decoded_frame_cache_mb = gr.Number(
+            label='decoded_frame_cache_mb (memory for decoded reference and input frames shared by all loops, 0 to disable)',
+            precision=0, value=1024
+        )
+        frame_store_budget_mb = gr.Number(
+            label='frame_store_budget_mb (keep the last loop\'s frames in memory up to this size, 0 to read them from disk)',
+            precision=0, value=2048
+        )
+        record_timings = gr.Checkbox(
+            label='record_timings (write the time spent in each stage to <timestamp>_timings.json)',
+            value=False
+        )
+        # several webui instances share the frames of every loop
+        shard_role = gr.Dropdown(
+            label='shard_role (coordinator splits each loop into jobs, workers wait for jobs until interrupted)',
+            choices=list(SHARD_ROLES),
+            value='off'
+        )
+        shard_queue_dir = gr.Textbox(
+            label='shard_queue_directory',
+            value='',
+            placeholder='A directory shared by the coordinator and its workers'
+        )
+        shard_size = gr.Number(label='shard_size (frames per job)', precision=0, value=16)
 
         # MASAControl settings
         masa_control_use_index = gr.Checkbox(label='masa_control_use_index', value=False)
@@ -329,9 +426,14 @@ class Script(modules.scripts.Script):
                             "lambda img: img.filter(ImageFilter.EDGE_ENHANCE).filter(ImageFilter.SMOOTH) "
                             "if loop_i in {6,8} else img "
             )
+            blend_engine = gr.Dropdown(
+                label='blend_engine (used by batch blend and temporal blend)',
+                choices=['numpy', 'PIL'],
+                value='numpy'
+            )
             video_post_process_method = gr.Dropdown(
                 label='video_post_process_method',
-                choices=['None', 'FastDVDNet'],
+                choices=['None', 'FastDVDNet', 'FastDVDNet (CPU)'],
                 value='None'
             )
             video_post_process_alpha = gr.Slider(
@@ -343,8 +445,44 @@ class Script(modules.scripts.Script):
                     label='fastdvdnet_noise_sigma',
                     minimum=0, maximum=255, step=1, value=60
                 )
+                fastdvdnet_precision = gr.Dropdown(
+                    label='fastdvdnet_precision (bf16 and int8 need fastdvdnet_precision.py to validate them first)',
+                    choices=['fp32', 'bf16', 'int8'],
+                    value='fp32'
+                )
+                fastdvdnet_chunk_size = gr.Number(
+                    label='fastdvdnet_chunk_size (frames denoised at once, 0 to load the whole loop)',
+                    precision=0, value=32
+                )
+                fastdvdnet_batch_size = gr.Number(
+                    label='fastdvdnet_batch_size (frames per forward call)',
+                    precision=0, value=4
+                )
+                fastdvdnet_fused = gr.Checkbox(
+                    label='fastdvdnet_fused (fold BatchNorm into the convolutions, cached next to model.pth)',
+                    value=True
+                )
+                fastdvdnet_cpu_threads = gr.Number(
+                    label='fastdvdnet_cpu_threads (threads of the CPU backend, 0 for the torch default)',
+                    precision=0, value=0
+                )
+                fastdvdnet_tile_size = gr.Number(
+                    label='fastdvdnet_tile_size (denoise larger frames in tiles, 0 to disable)',
+                    precision=0, value=0
+                )
+                fastdvdnet_tile_overlap = gr.Number(
+                    label='fastdvdnet_tile_overlap (pixels shared by neighbouring tiles)',
+                    precision=0, value=32
+                )
+                # the model stays loaded between runs
+                fastdvdnet_unload = gr.Button(value='Unload FastDVDNet')
+                fastdvdnet_unload.click(
+                    fn=unload_fastdvdnet,
+                    show_progress=False,
+                    inputs=[], outputs=[]
+                )
             video_post_process_method.change(
-                lambda x: gr_show(x == 'FastDVDNet'),
+                lambda x: gr_show(x.startswith('FastDVDNet')),
                 show_progress=False,
                 inputs=[video_post_process_method],
                 outputs=[video_post_process_fastdvdnet_box]
@@ -385,9 +523,61 @@ class Script(modules.scripts.Script):
             image_post_processing_schedule,
             video_post_process_method,
             video_post_process_alpha,
-            fastdvdnet_noise_sigma
+            fastdvdnet_noise_sigma,
+            stream_input_video,
+            frame_store_budget_mb,
+            prefetch_frames,
+            decoded_frame_cache_mb,
+            blend_engine,
+            fastdvdnet_chunk_size,
+            fastdvdnet_cpu_threads,
+            fastdvdnet_batch_size,
+            fastdvdnet_fused,
+            fastdvdnet_tile_size,
+            fastdvdnet_tile_overlap,
+            fastdvdnet_precision,
+            resume_run_dir,
+            record_timings,
+            shard_role,
+            shard_queue_dir,
+            shard_size
         ]
 
+    def run_shard_worker(self, p, shard_queue_dir, run_args):
+        """Generates the jobs put in the queue by coordinators, until interrupted
+        or until a STOP file is put in the queue directory."""
+        if not shard_queue_dir:
+            raise ValueError('shard_queue_dir is empty')
+        queue = ShardQueue(shard_queue_dir)
+        print(f'waiting for jobs in {queue.queue_dir}')
+        processed = None
+        shared.state.begin()
+        try:
+            while not shared.state.interrupted and not queue.stopped():
+                job = queue.claim()
+                if job is None:
+                    time.sleep(POLL_SECONDS)
+                    continue
+                print(f"{job.name}: Loop:{job.loop_i + 1},Image:{job.start_i + 1}-{job.end_i}")
+                try:
+                    # a job is generated with the settings of its run
+                    resume = RunResume(job.run_dir)
+                    resume.apply_to(p)
+                    job_args = resume.run_args(run_args)
+                    job_args.update(resume_run_dir='', shard_role='off')
+                    processed = self.run(p, **job_args, _resume=resume, _shard_job=job)
+                except Exception as e:
+                    traceback.print_exc()
+                    queue.fail(job, e)
+                    continue
+                if shared.state.interrupted:
+                    queue.release(job)
+                else:
+                    queue.complete(job)
+        finally:
+            shared.state.end()
+        return processed if processed is not None else Processed(p, [])
+
     def run(self, p,
             input_dir,
             output_dir,
@@ -423,14 +613,52 @@ class Script(modules.scripts.Script):
             image_post_processing_schedule,
             video_post_process_method,
             video_post_process_alpha,
-            fastdvdnet_noise_sigma):
+            fastdvdnet_noise_sigma,
+            stream_input_video,
+            frame_store_budget_mb,
+            prefetch_frames,
+            decoded_frame_cache_mb,
+            blend_engine,
+            fastdvdnet_chunk_size,
+            fastdvdnet_cpu_threads,
+            fastdvdnet_batch_size,
+            fastdvdnet_fused,
+            fastdvdnet_tile_size,
+            fastdvdnet_tile_overlap,
+            fastdvdnet_precision,
+            resume_run_dir,
+            record_timings,
+            shard_role,
+            shard_queue_dir,
+            shard_size,
+            _resume=None,
+            _shard_job=None):
+
+        if shard_role == 'worker' and _shard_job is None:
+            run_args = {
+                k: v for k, v in locals().items()
+                if k not in ('self', 'p', '_resume', '_shard_job')
+            }
+            return self.run_shard_worker(p, shard_queue_dir, run_args)
+
+        if resume_run_dir and _resume is None:
+            # continue the interrupted run with its own settings
+            run_args = {
+                k: v for k, v in locals().items()
+                if k not in ('self', 'p', 'resume_run_dir', '_resume', '_shard_job')
+            }
+            resume = RunResume(resume_run_dir)
+            resume.apply_to(p)
+            return self.run(
+                p, **resume.run_args(run_args),
+                resume_run_dir=resume_run_dir, _resume=resume)
 
         processing.fix_seed(p)
         p.do_not_save_grid = True
         p.do_not_save_samples = True
         processed = None
 
-        timestamp = get_now_time()
+        timestamp = get_now_time() if _resume is None else _resume.timestamp
 
         if not input_dir:
             raise ValueError('input_dir is empty')
@@ -438,6 +666,19 @@ class Script(modules.scripts.Script):
             raise ValueError('output_dir is empty')
 
         utils.resize_mode = p.resize_mode
+        utils.blend_engine = blend_engine
+
+        shard_queue = None
+        if shard_role == 'coordinator':
+            if not shard_queue_dir:
+                raise ValueError('shard_queue_dir is empty')
+            if masa_control_active_range != "":
+                print('Warning: MasaCtrl keeps the attention maps of a section in the instance '
+                      'that logged them, the run is not sharded')
+            else:
+                shard_queue = ShardQueue(shard_queue_dir)
+                # the workers read the extracted frames
+                stream_input_video = False
 
         # save settings
         args_dict = {
@@ -477,6 +718,23 @@ class Script(modules.scripts.Script):
             "video_post_process_method": video_post_process_method,
             "video_post_process_alpha": video_post_process_alpha,
             "fastdvdnet_noise_sigma": fastdvdnet_noise_sigma,
+            "stream_input_video": stream_input_video,
+            "frame_store_budget_mb": frame_store_budget_mb,
+            "prefetch_frames": prefetch_frames,
+            "decoded_frame_cache_mb": decoded_frame_cache_mb,
+            "blend_engine": blend_engine,
+            "fastdvdnet_chunk_size": fastdvdnet_chunk_size,
+            "fastdvdnet_cpu_threads": fastdvdnet_cpu_threads,
+            "fastdvdnet_batch_size": fastdvdnet_batch_size,
+            "fastdvdnet_fused": fastdvdnet_fused,
+            "fastdvdnet_tile_size": fastdvdnet_tile_size,
+            "fastdvdnet_tile_overlap": fastdvdnet_tile_overlap,
+            "fastdvdnet_precision": fastdvdnet_precision,
+            "resume_run_dir": resume_run_dir,
+            "record_timings": record_timings,
+            "shard_role": shard_role,
+            "shard_queue_dir": shard_queue_dir,
+            "shard_size": shard_size,
 
             # "p": p.__dict__
             "seed": p.seed,
@@ -497,288 +755,572 @@ class Script(modules.scripts.Script):
             "model_name": shared.sd_model.sd_checkpoint_info.model_name,
             "model_hash": shared.sd_model.sd_model_hash
         }
+        if _resume is not None and \
+                _resume.settings.get('model_hash') != args_dict['model_hash']:
+            print(f"Warning: {timestamp} was made with {_resume.settings.get('model_name')}, "
+                  f"the current model is {args_dict['model_name']}")
 
         output_dir = Path(output_dir) / timestamp
         output_frames_dir = output_dir/"output_frames"
         output_frames_dir.mkdir(exist_ok=True, parents=True)
 
         settings_file_name = f'{timestamp}.json'
-        with open(output_dir/settings_file_name, 'w', encoding='utf-8') as f:
-            json.dump(args_dict, f, indent=4, ensure_ascii=False)
+        # per stage timings, written next to the settings at the end of every loop
+        timer = timings.timer
+        timer.start(bool(record_timings) and _shard_job is None)
+        timings_file = output_dir/f'{timestamp}_timings.json'
+        # the settings of a sharded run belong to its coordinator
+        if _shard_job is None:
+            with open(output_dir/settings_file_name, 'w', encoding='utf-8') as f:
+                json.dump(args_dict, f, indent=4, ensure_ascii=False)
 
         input_dir = Path(input_dir)
         assert input_dir.exists()
-        if input_dir.is_file() and not is_image(input_dir):  # 输入为视频文件
-            extract_dir = output_dir / 'input_frames'
-            extract_dir.mkdir()
-            os.system(f'ffmpeg -i "{input_dir}" "{extract_dir / "%07d.png"}" ')
-            input_dir = extract_dir
-
-        if is_image(input_dir):  # 输入为单张图片
-            image_list = [input_dir] * max_frames
-        else:
-            image_list = get_image_paths(input_dir)
-            if not is_continuous:
-                image_list = image_list[::extract_nth_frame]
-            image_list = image_list[:max_frames]
-        image_n = len(image_list)
-
-        temporal_superimpose_alpha_list = \
-            [float(x) for x in temporal_superimpose_alpha_list.split(',') if x
-             ] or [1]
-        assert len(temporal_superimpose_alpha_list) % 2 == 1
-
-        # make video_post_processor
-        video_post_processor = None
-        if 'FastDVDNet' == video_post_process_method:
-            print('using FastDVDNet as video post processor')
-            video_post_processor = FastDVDNet(
-                alpha=video_post_process_alpha,
-                noise_sigma=fastdvdnet_noise_sigma
-            )
-
-        shared.state.begin()
-        shared.state.job_count = loop_n * image_n * p.n_iter
-
-        schedule_args = dict(ImageFilter=ImageFilter, **math.__dict__)
-
-        if read_prompt_from_txt:
-            default_prompt = p.prompt
-            default_neg_prompt = p.negative_prompt
-            prompt_list = get_prompt_for_images(image_list)
-
-        # init references
-        if not reference_frames_dir:
-            reference_image_list = [image_list]
-        else:
-            reference_image_list = [
-                get_image_paths(Path(p))[::extract_nth_frame][:max_frames]
-                for p in reference_frames_dir.split('!!!') if p
-            ]  # 可能为空
-        reference_img_ques = [
-            TemporalImageBlender(
-                image_path_list=image_list,
-                window_size=len(temporal_superimpose_alpha_list),
-                target_size=(p.width, p.height),
-                use_mask=use_mask, mask_dir=mask_dir,
-                mask_threshold=mask_threshold
-            )
-            for image_list in reference_image_list
-        ]
-
-
-        def parse_ranges(text):
-            sections = text.split(';')
-            sections_list = []
-            for section in sections:
-                intervals_list = []
-                intervals = section.split(',')
-                for interval in intervals:
-                    start, end = map(int, interval.split('-'))
-                    intervals_list.append([start, end])
-                sections_list.append(intervals_list)
-            return sections_list
-        masa_ctrl_logging_list = []
-        masa_ctrl_logrecon_list = []
-
-        if masa_control_active_range != "":
-            masa_ctrl_sections_list = parse_ranges(masa_control_active_range)
-
-            for section in masa_ctrl_sections_list:
-                intervals_list = section
-                masa_ctrl_logging_list.append(intervals_list[0][0])
-                for i, interval in enumerate(intervals_list):
-                    if not i == 0:
-                        masa_ctrl_logrecon_list.append(interval[0])
-                    masa_ctrl_logrecon_list.extend(list(range(interval[0]+1, interval[1]+1)))
-
-
-
-
-
-        for loop_i in range(loop_n):
-            if shared.state.interrupted:
-                break
-
-            if loop_i > 0:
-                image_list = get_image_paths(output_frames_dir)
-            output_frames_dir = output_dir/"output_frames"/f"loop_{loop_i+1}"
-            output_frames_dir.mkdir()
+        input_reader = None
+        prefetch_executor = None
+        frame_saver = None
+        video_writer = None
+        try:
+            if input_dir.is_file() and not is_image(input_dir):  # 输入为视频文件
+                extract_dir = output_dir / 'input_frames'
+                if stream_input_video:
+                    input_reader = FFmpegFrameReader(
+                        input_dir, extract_dir,
+                        extract_nth_frame=1 if is_continuous else extract_nth_frame,
+                        max_frames=max_frames
+                    )
+                elif _resume is None or not extract_dir.is_dir():
+                    extract_dir.mkdir()
+                    os.system(f'ffmpeg -i "{input_dir}" "{extract_dir / "%07d.png"}" ')
+                input_dir = extract_dir
+
+            if input_reader is not None:  # 逐帧从ffmpeg管道读取
+                image_list = input_reader
+            elif is_image(input_dir):  # 输入为单张图片
+                image_list = [input_dir] * max_frames
+            else:
+                image_list = get_image_paths(input_dir)
+                if not is_continuous:
+                    image_list = image_list[::extract_nth_frame]
+                image_list = image_list[:max_frames]
+            image_n = len(image_list)
+
+            temporal_superimpose_alpha_list = \
+                [float(x) for x in temporal_superimpose_alpha_list.split(',') if x
+                 ] or [1]
+            assert len(temporal_superimpose_alpha_list) % 2 == 1
+
+            # make video_post_processor
+            video_post_processor = None
+            if _shard_job is None and video_post_process_method.startswith('FastDVDNet'):
+                print(f'using {video_post_process_method} as video post processor')
+                video_post_processor = get_fastdvdnet(
+                    device='cpu' if 'FastDVDNet (CPU)' == video_post_process_method else 'cuda',
+                    precision=fastdvdnet_precision,
+                    fused=fastdvdnet_fused
+                )
 
-            img_que = TemporalImageBlender(
-                image_path_list=image_list,
-                window_size=len(temporal_superimpose_alpha_list),
-                target_size=(p.width, p.height),
-                use_mask=use_mask, mask_dir=mask_dir,
-                mask_threshold=mask_threshold
+            # check every schedule up front, so a bad one fails before the first frame
+            schedule_args = dict(ImageFilter=ImageFilter, **math.__dict__)
+            schedule_table = ScheduleTable(
+                {
+                    'subseed_strength_schedule': subseed_strength_schedule,
+                    'denoising_schedule': denoising_schedule,
+                    'step_schedule': step_schedule,
+                    'seed_schedule': seed_schedule,
+                    'subseed_schedule': subseed_schedule,
+                    'cfg_schedule': cfg_schedule,
+                    'superimpose_alpha_schedule': superimpose_alpha_schedule,
+                    'temporal_superimpose_schedule': temporal_superimpose_schedule,
+                    'prompt_schedule': prompt_schedule,
+                    'negative_prompt_schedule': negative_prompt_schedule,
+                    'batch_count_schedule': batch_count_schedule,
+                    'image_post_processing_schedule': image_post_processing_schedule,
+                },
+                schedule_args, loop_n, image_n,
+                temporal_window=len(temporal_superimpose_alpha_list),
+                # the coordinator has checked them for the jobs
+                validate=_shard_job is None
             )
+            for name, value in schedule_table.constant.items():
+                print(f"{name} is constant:{value}")
+
+            # MasaCtrl mode of every frame, checked before the first frame
+            masa_plan = None
+            masactrl_script = None
+            masa_mode = None  # the mode currently in p.script_args
+            if masa_control_active_range != "":
+                masa_plan = MasaCtrlRangePlan(
+                    masa_control_active_range,
+                    logging_mode=MasaControllerMode.LOGGING,
+                    logrecon_mode=MasaControllerMode.LOGRECON,
+                    idle_mode=MasaControllerMode.IDLE
+                )
+                masactrl_script = find_masactrl_script()
+                if masactrl_script is None:
+                    print('Warning: MasaCtrl script not found, masa_control_active_range is ignored')
+            if _shard_job is None:
+                args_dict['schedule_table'] = schedule_table.to_json()
+                with open(output_dir/settings_file_name, 'w', encoding='utf-8') as f:
+                    json.dump(args_dict, f, indent=4, ensure_ascii=False)
+
+                shared.state.begin()
+                shared.state.job_count = loop_n * image_n * p.n_iter
+            else:
+                shared.state.job_count = (_shard_job.end_i - _shard_job.start_i) * p.n_iter
+
+            if read_prompt_from_txt:
+                default_prompt = p.prompt
+                default_neg_prompt = p.negative_prompt
+                prompt_list = get_prompt_for_images(image_list)
+
+            if prefetch_frames > 0:
+                prefetch_executor = ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix='video_loopback_prefetch')
+
+            # reference frames never change during a run, keep them decoded
+            frame_cache = None
+            decoded_frame_cache.set_budget(max(decoded_frame_cache_mb, 0) * 2**20)
+            if decoded_frame_cache_mb > 0:
+                frame_cache = decoded_frame_cache
+            else:
+                decoded_frame_cache.clear()
 
-            for image_i, image_path in enumerate(image_list):
-                if shared.state.interrupted:
-                    break
-
-                print('='*10)
-                print(f"Loop:{loop_i + 1}/{loop_n},Image:{image_i + 1}/{image_n}")
-                # shared.state.job = f"Loop:{loop_i + 1}/{loop_n},Image:{image_i + 1}/{image_n}"
-
-                output_filename = output_frames_dir / f"{image_i:07d}.png"
-
-                # do all schedule
-                schedule_args.update({'image_i': image_i+1, 'loop_i': loop_i+1})
+            mask_provider = None
+            if use_mask:
+                mask_provider = MaskProvider(
+                    mask_dir, mask_threshold, target_size=(p.width, p.height))
 
-                target_masactrl_script_object = next(
-                    (v for v in scripts.scripts_img2img.scripts if str(v).startswith('<masactrl_ui.py.Script')), None)
+            # init references
+            if not reference_frames_dir:
+                reference_image_list = [image_list]
+            else:
+                reference_image_list = [
+                    get_image_paths(Path(p))[::extract_nth_frame][:max_frames]
+                    for p in reference_frames_dir.split('!!!') if p
+                ]  # 可能为空
+            reference_img_ques = [
+                TemporalImageBlender(
+                    image_path_list=image_list,
+                    window_size=len(temporal_superimpose_alpha_list),
+                    target_size=(p.width, p.height),
+                    use_mask=use_mask, mask_dir=mask_dir,
+                    mask_threshold=mask_threshold,
+                    prefetch_executor=prefetch_executor,
+                    prefetch_depth=prefetch_frames,
+                    frame_cache=frame_cache,
+                    mask_provider=mask_provider
+                )
+                for image_list in reference_image_list
+            ]
 
-                if masa_control_use_index:
-                    input_img_stem = image_i
-                else:
-                    input_img_stem = int(Path(image_path).stem)
 
-                if masa_control_active_range != "":
-                    if input_img_stem in masa_ctrl_logging_list:
-                        update_script_args(p, MasaControllerMode.LOGGING,0,target_masactrl_script_object.__class__)
-                    elif input_img_stem in masa_ctrl_logrecon_list:
-                        update_script_args(p, MasaControllerMode.LOGRECON,0,target_masactrl_script_object.__class__)
-                    else:
-                        update_script_args(p, MasaControllerMode.IDLE,0,target_masactrl_script_object.__class__)
-
-                if subseed_strength_schedule:
-                    p.subseed_strength = eval(subseed_strength_schedule, schedule_args)
-                    print(f"subseed_strength_schedule:{p.subseed_strength}")
-                if denoising_schedule:
-                    p.denoising_strength = eval(denoising_schedule, schedule_args)
-                    print(f"denoising_schedule:{p.denoising_strength}")
-                if step_schedule:
-                    p.steps = eval(step_schedule, schedule_args)
-                    print(f"step_schedule:{p.steps}")
-                if seed_schedule:
-                    p.seed = eval(seed_schedule, schedule_args)
-                    print(f"seed_schedule:{p.seed}")
-                if subseed_schedule:
-                    p.subseed = eval(subseed_schedule, schedule_args)
-                    print(f"subseed_schedule:{p.subseed}")
-                if cfg_schedule:
-                    p.cfg_scale = eval(cfg_schedule, schedule_args)
-                    print(f"cfg_schedule:{p.cfg_scale}")
-                if superimpose_alpha_schedule:
-                    superimpose_alpha = eval(superimpose_alpha_schedule, schedule_args)
-                    print(f"superimpose_alpha_schedule:{superimpose_alpha}")
-                if temporal_superimpose_schedule:
-                    new_temporal_superimpose_list = eval(temporal_superimpose_schedule, schedule_args)
-                    assert len(temporal_superimpose_alpha_list) == len(new_temporal_superimpose_list)
-                    temporal_superimpose_alpha_list = new_temporal_superimpose_list
-                    print(f"temporal_superimpose_schedule:{temporal_superimpose_alpha_list}")
-                if prompt_schedule:
-                    p.prompt = eval(prompt_schedule, schedule_args)
-                    print(f"prompt_schedule:{p.prompt}")
-                if negative_prompt_schedule:
-                    p.negative_prompt = eval(negative_prompt_schedule, schedule_args)
-                    print(f"negative_prompt_schedule:{p.negative_prompt}")
+            def replay_seeds(loop_i, image_i):
+                """Advances p like generating the frame does, returns the
+                (seed, subseed, n_iter, batch_size) the frame is generated with."""
+                schedule = schedule_table.values(loop_i, image_i)
                 if batch_count_schedule:
-                    new_batch_count = eval(batch_count_schedule, schedule_args)
+                    new_batch_count = schedule['batch_count_schedule']
                     if isinstance(new_batch_count, tuple):
                         p.n_iter, p.batch_size = new_batch_count
-                        print(f"batch_count_schedule: batch_count:{p.n_iter}, batch_size:{p.batch_size}")
                     else:
                         p.n_iter = new_batch_count
-                        print(f"batch_count_schedule:{p.n_iter}")
-
-                image_post_processing = None
-                if image_post_processing_schedule:
-                    image_post_processing = eval(image_post_processing_schedule, schedule_args)
-                    print(f"image_post_processing_schedule:{image_post_processing_schedule}")
-
-                if read_prompt_from_txt:
-                    prompt, neg_prompt = prompt_list[image_i]
-                    if prompt is not None:
-                        p.prompt = prompt
-                    elif not prompt_schedule:
-                        p.prompt = default_prompt
-                    if neg_prompt is not None:
-                        p.negative_prompt = neg_prompt
-                    elif not negative_prompt_schedule:
-                        p.negative_prompt = default_neg_prompt
-                    print(f"prompt: {p.prompt} \n"
-                          f"negative prompt: {p.negative_prompt}")
-
-                # make base img for i2i
-                if "with difference mask from reference" == temporal_superimpose_method:
-                    if len(reference_img_ques) <= 0:
-                        raise ValueError('Current temporal superimpose method need reference')
-                    base_img = img_que.blend_temporal_diff(
-                        temporal_superimpose_alpha_list,
-                        reference_img_list=reference_img_ques[0].window
-                    )
-                else:
-                    base_img = img_que.blend_temporal(temporal_superimpose_alpha_list)
-
-                print(f"seed:{p.seed}, subseed:{p.subseed}")
-
-                p.init_images = [base_img]
-                p.image_mask = img_que.current_mask()
-                # mask像素为0表示不变
-
-                # 使用 sd-webui-controlnet
-                p.control_net_input_image = [
-                    que.current_image()
-                    for que in reference_img_ques
-                ]
-
-                processed = processing.process_images(p)
+                if seed_schedule:
+                    p.seed = schedule['seed_schedule']
+                if subseed_schedule:
+                    p.subseed = schedule['subseed_schedule']
+                frame = (p.seed, p.subseed, p.n_iter, p.batch_size)
+                if not fix_seed and not seed_schedule:
+                    p.seed = p.seed + p.n_iter * p.batch_size
+                if not fix_subseed and not subseed_schedule:
+                    p.subseed = p.subseed + p.n_iter * p.batch_size
+                return frame
+
+            def make_img_que(image_list, loop_i):
+                return TemporalImageBlender(
+                    image_path_list=image_list,
+                    window_size=len(temporal_superimpose_alpha_list),
+                    target_size=(p.width, p.height),
+                    use_mask=use_mask, mask_dir=mask_dir,
+                    mask_threshold=mask_threshold,
+                    frame_saver=frame_saver,
+                    prefetch_executor=prefetch_executor,
+                    prefetch_depth=prefetch_frames,
+                    # 第一轮的输入帧可能和参考帧相同
+                    frame_cache=frame_cache if loop_i == 0 else None,
+                    mask_provider=mask_provider
+                )
 
-                # masactrl post process
-                if masa_control_active_range != "":
-                    if input_img_stem in masa_ctrl_logging_list + masa_ctrl_logrecon_list:
+            def process_frames(loop_i, img_que, image_list, output_frames_dir, start_i, end_i,
+                               frame_store=None, video_writer=None, frames=None):
+                """Generates the frames [start_i, end_i) of a loop.
+
+                A shard passes the (seed, subseed, n_iter, batch_size) of its
+                frames in ``frames``, otherwise p is advanced from frame to frame.
+                """
+                nonlocal processed, superimpose_alpha, temporal_superimpose_alpha_list, masa_mode
+                for image_i in range(start_i, end_i):
+                    if shared.state.interrupted:
+                        break
+                    image_path = image_list[image_i]
+
+                    print('='*10)
+                    timer.begin_frame(loop_i, image_i)
+                    print(f"Loop:{loop_i + 1}/{loop_n},Image:{image_i + 1}/{image_n}")
+                    # shared.state.job = f"Loop:{loop_i + 1}/{loop_n},Image:{image_i + 1}/{image_n}"
+
+                    output_filename = output_frames_dir / f"{image_i:07d}.png"
+
+                    # do all schedule
+                    schedule = schedule_table.values(loop_i, image_i)
+
+                    if masa_plan is not None:
+                        if masa_control_use_index:
+                            input_img_stem = image_i
+                        else:
+                            input_img_stem = int(Path(image_path).stem)
+
+                        # p.script_args is only rebuilt when the mode changes
+                        new_masa_mode = masa_plan.mode_at(input_img_stem)
+                        if masactrl_script is not None and new_masa_mode != masa_mode:
+                            update_script_args(p, new_masa_mode, 0, masactrl_script)
+                            masa_mode = new_masa_mode
+
+                    if subseed_strength_schedule:
+                        p.subseed_strength = schedule['subseed_strength_schedule']
+                        print(f"subseed_strength_schedule:{p.subseed_strength}")
+                    if denoising_schedule:
+                        p.denoising_strength = schedule['denoising_schedule']
+                        print(f"denoising_schedule:{p.denoising_strength}")
+                    if step_schedule:
+                        p.steps = schedule['step_schedule']
+                        print(f"step_schedule:{p.steps}")
+                    if seed_schedule:
+                        p.seed = schedule['seed_schedule']
+                        print(f"seed_schedule:{p.seed}")
+                    if subseed_schedule:
+                        p.subseed = schedule['subseed_schedule']
+                        print(f"subseed_schedule:{p.subseed}")
+                    if cfg_schedule:
+                        p.cfg_scale = schedule['cfg_schedule']
+                        print(f"cfg_schedule:{p.cfg_scale}")
+                    if superimpose_alpha_schedule:
+                        superimpose_alpha = schedule['superimpose_alpha_schedule']
+                        print(f"superimpose_alpha_schedule:{superimpose_alpha}")
+                    if temporal_superimpose_schedule:
+                        temporal_superimpose_alpha_list = schedule['temporal_superimpose_schedule']
+                        print(f"temporal_superimpose_schedule:{temporal_superimpose_alpha_list}")
+                    if prompt_schedule:
+                        p.prompt = schedule['prompt_schedule']
+                        print(f"prompt_schedule:{p.prompt}")
+                    if negative_prompt_schedule:
+                        p.negative_prompt = schedule['negative_prompt_schedule']
+                        print(f"negative_prompt_schedule:{p.negative_prompt}")
+                    if batch_count_schedule:
+                        new_batch_count = schedule['batch_count_schedule']
+                        if isinstance(new_batch_count, tuple):
+                            p.n_iter, p.batch_size = new_batch_count
+                            print(f"batch_count_schedule: batch_count:{p.n_iter}, batch_size:{p.batch_size}")
+                        else:
+                            p.n_iter = new_batch_count
+                            print(f"batch_count_schedule:{p.n_iter}")
+                    if frames is not None:
+                        p.seed, p.subseed, p.n_iter, p.batch_size = frames[image_i - start_i]
+
+                    image_post_processing = None
+                    if image_post_processing_schedule:
+                        image_post_processing = schedule['image_post_processing_schedule']
+                        print(f"image_post_processing_schedule:{image_post_processing_schedule}")
+
+                    if read_prompt_from_txt:
+                        prompt, neg_prompt = prompt_list[image_i]
+                        if prompt is not None:
+                            p.prompt = prompt
+                        elif not prompt_schedule:
+                            p.prompt = default_prompt
+                        if neg_prompt is not None:
+                            p.negative_prompt = neg_prompt
+                        elif not negative_prompt_schedule:
+                            p.negative_prompt = default_neg_prompt
+                        print(f"prompt: {p.prompt} \n"
+                              f"negative prompt: {p.negative_prompt}")
+
+                    with timer.stage('mask'):
+                        image_mask = img_que.current_mask()
+
+                    # make base img for i2i
+                    with timer.stage('temporal_blend'):
+                        if "with difference mask from reference" == temporal_superimpose_method:
+                            if len(reference_img_ques) <= 0:
+                                raise ValueError('Current temporal superimpose method need reference')
+                            base_img = img_que.blend_temporal_diff(
+                                temporal_superimpose_alpha_list,
+                                reference_img_list=reference_img_ques[0].window
+                            )
+                        else:
+                            base_img = img_que.blend_temporal(temporal_superimpose_alpha_list)
+
+                    print(f"seed:{p.seed}, subseed:{p.subseed}")
+
+                    p.init_images = [base_img]
+                    p.image_mask = image_mask
+                    # mask像素为0表示不变
+
+                    # 使用 sd-webui-controlnet
+                    p.control_net_input_image = [
+                        que.current_image()
+                        for que in reference_img_ques
+                    ]
+
+                    with timer.stage('process_images'):
+                        processed = processing.process_images(p)
+
+                    # masactrl post process
+                    if masa_plan is not None and masa_plan.is_active(input_img_stem):
                         shared.masa_controller.calculate_reconstruction_maps()
 
-                processed_imgs = processed.images
-                processed_imgs = [
-                    img for img in processed_imgs
-                    if isinstance(img, Image.Image)
-                ][:p.n_iter*p.batch_size]
-
-                # batch blend
-                output_img = img_que.blend_batch(
-                        processed_imgs, superimpose_alpha)
-
-                if image_post_processing:
-                    output_img = image_post_processing(output_img)
+                    processed_imgs = processed.images
+                    processed_imgs = [
+                        img for img in processed_imgs
+                        if isinstance(img, Image.Image)
+                    ][:p.n_iter*p.batch_size]
+
+                    # batch blend
+                    with timer.stage('batch_blend'):
+                        output_img = img_que.blend_batch(
+                                processed_imgs, superimpose_alpha)
+
+                    if image_post_processing:
+                        with timer.stage('image_post_processing'):
+                            output_img = image_post_processing(output_img)
+
+                    # output_img.save(output_filename)
+                    with timer.stage('save'):
+                        img_que.save_current_output_image(output_filename, output_img)
+                        if frame_store is not None:
+                            frame_store.put(output_filename, output_img)
+                    if video_writer is not None:
+                        with timer.stage('video_write'):
+                            video_writer.write(output_img)
+
+                    img_que.move_to_next()
+                    for que in reference_img_ques:
+                        que.move_to_next()
+
+                    if frames is None:
+                        if not fix_seed and not seed_schedule:
+                            p.seed = processed.seed + p.n_iter * p.batch_size
+                        if not fix_subseed and not subseed_schedule:
+                            p.subseed = processed.subseed + p.n_iter * p.batch_size
+                    timer.end_frame()
+
+            input_image_list = image_list
+
+            def run_job(job):
+                # the previous loop is complete on disk once its jobs are done
+                loop_image_list = input_image_list if job.loop_i == 0 else \
+                    get_image_paths(output_dir/"output_frames"/f"loop_{job.loop_i}")
+                img_que = make_img_que(loop_image_list, job.loop_i)
+                img_que.seek(job.start_i)
+                for que in reference_img_ques:
+                    que.seek(job.start_i)
+                with job.keep_alive():
+                    process_frames(
+                        job.loop_i, img_que, loop_image_list,
+                        output_dir/"output_frames"/f"loop_{job.loop_i + 1}",
+                        job.start_i, job.end_i,
+                        frames=job.frames
+                    )
+                    frame_saver.flush()
+
+            def run_shards(job_names):
+                # work on the jobs of this run next to the workers, until all of them are done
+                try:
+                    while not shared.state.interrupted:
+                        job = shard_queue.claim(prefix=f'{timestamp}-loop_')
+                        if job is not None:
+                            print(f"{job.name} is generated by the coordinator")
+                            try:
+                                run_job(job)
+                            except BaseException as e:
+                                shard_queue.fail(job, e)
+                                raise
+                            if shared.state.interrupted:
+                                shard_queue.release(job)
+                            else:
+                                shard_queue.complete(job)
+                            continue
+                        if shard_queue.finished(job_names):
+                            return
+                        shard_queue.requeue_stale()
+                        time.sleep(POLL_SECONDS)
+                    # interrupted, the loop folder is only read once the workers have left it
+                    print("waiting for the workers to finish the jobs they have started")
+                    shard_queue.drain(job_names)
+                finally:
+                    # nobody should start the jobs of a failed or interrupted loop
+                    shard_queue.cancel(job_names)
+
+            # frames are saved atomically, a saved frame is never half written
+            frame_saver = AsyncFrameSaver(atomic=True)
+            if _shard_job is not None:
+                # a worker only generates the frames of its job
+                run_job(_shard_job)
+                frame_saver.shutdown()
+                return processed
+
+            streamed_video = None
+            frame_store = None
+            for loop_i in range(loop_n):
+                if shared.state.interrupted:
+                    break
+                timer.begin_loop(loop_i)
+
+                if loop_i > 0:
+                    # 上一轮的输出优先从内存读取
+                    image_list = frame_store if frame_store is not None \
+                        else get_image_paths(output_frames_dir)
+                output_frames_dir = output_dir/"output_frames"/f"loop_{loop_i+1}"
+                output_frames_dir.mkdir(exist_ok=_resume is not None)
+
+                start_i = 0
+                if _resume is not None:
+                    start_i, loop_done = _resume.loop_progress(output_frames_dir, image_n)
+                    for image_i in range(start_i):
+                        replay_seeds(loop_i, image_i)
+                    if loop_done:
+                        print(f"Loop:{loop_i + 1}/{loop_n} was completed, skipping it")
+                        frame_store = None
+                        continue
+                    if start_i > 0:
+                        print(f"Loop:{loop_i + 1}/{loop_n} resumes at image {start_i + 1}/{image_n}")
+
+                # the frames saved before resuming, or by the workers, are only on disk
+                frame_store = None if start_i > 0 or shard_queue is not None else \
+                    FrameStore(budget_bytes=max(frame_store_budget_mb, 0) * 2**20)
+
+                # encode the video while generating,
+                # unless the frames are rewritten by the video post processor afterwards,
+                # or part of them were generated before resuming or by the workers
+                video_writer = None
+                streamed_video = None
+                if video_post_processor is None and start_i == 0 and shard_queue is None:
+                    if save_every_loop:
+                        video_writer = FFmpegVideoWriter(
+                            output_dir/f'{timestamp}-loop_{loop_i+1}.mp4',
+                            frame_rate=output_frame_rate
+                        )
+                    elif loop_i == loop_n - 1:
+                        video_writer = FFmpegVideoWriter(
+                            output_dir/f'{timestamp}.mp4',
+                            frame_rate=output_frame_rate
+                        )
+
+                if shard_queue is not None:
+                    # the frames of a loop only depend on the previous loop,
+                    # their seeds are worked out here and given to the jobs
+                    frames = [replay_seeds(loop_i, image_i) for image_i in range(start_i, image_n)]
+                    loop_end_state = (p.seed, p.subseed, p.n_iter, p.batch_size)
+                    job_names = [
+                        shard_queue.put(
+                            output_dir, loop_i, start, end,
+                            frames[start - start_i:end - start_i])
+                        for start, end in split_range(start_i, image_n, shard_size)
+                    ]
+                    print(f"Loop:{loop_i + 1}/{loop_n} is split into {len(job_names)} jobs")
+                    with timer.stage('shards'):
+                        run_shards(job_names)
+                    p.seed, p.subseed, p.n_iter, p.batch_size = loop_end_state
+                else:
+                    img_que = make_img_que(image_list, loop_i)
+                    if 0 < start_i < image_n:
+                        img_que.seek(start_i)
+                        for que in reference_img_ques:
+                            que.seek(start_i)
+                    process_frames(
+                        loop_i, img_que, image_list, output_frames_dir,
+                        start_i, len(image_list),
+                        frame_store=frame_store, video_writer=video_writer
+                    )
 
-                # output_img.save(output_filename)
-                img_que.save_current_output_image(output_filename, output_img)
+                # all frames of this loop must be on disk before they are read again
+                with timer.stage('save_flush'):
+                    frame_saver.flush()
+                # an interrupted loop is post processed and encoded once it is resumed and finished
+                loop_finished = not shared.state.interrupted
+
+                # post process
+                if video_post_processor is not None and loop_finished:
+                    with timer.stage('fastdvdnet'):
+                        post_process_once(
+                            output_frames_dir,
+                            lambda staging_dir: video_post_processor.process(
+                                output_frames_dir,
+                                alpha=video_post_process_alpha,
+                                noise_sigma=fastdvdnet_noise_sigma,
+                                chunk_size=fastdvdnet_chunk_size,
+                                batch_size=fastdvdnet_batch_size,
+                                num_threads=fastdvdnet_cpu_threads,
+                                tile_size=fastdvdnet_tile_size,
+                                tile_overlap=fastdvdnet_tile_overlap,
+                                output_path=staging_dir
+                            )
+                        )
+                    frame_store = None  # the frames on disk have been rewritten
+
+                if video_writer is not None:
+                    with timer.stage('video_close'):
+                        if video_writer.close():
+                            streamed_video = video_writer.output_filename
+
+                if save_every_loop and streamed_video is None and loop_finished:
+                    output_video_name = f'{timestamp}-loop_{loop_i+1}.mp4'
+                    with timer.stage('make_video'):
+                        make_video(
+                            input_dir=output_frames_dir,
+                            output_filename=output_dir/output_video_name,
+                            frame_rate=output_frame_rate
+                        )
 
-                img_que.move_to_next()
                 for que in reference_img_ques:
-                    que.move_to_next()
+                    que.reset()
 
-                if not fix_seed and not seed_schedule:
-                    p.seed = processed.seed + p.n_iter * p.batch_size
-                if not fix_subseed and not subseed_schedule:
-                    p.subseed = processed.subseed + p.n_iter * p.batch_size
-
-            # post process
-            if video_post_processor is not None:
-                video_post_processor.process(output_frames_dir)
-
-            if save_every_loop:
-                output_video_name = f'{timestamp}-loop_{loop_i+1}.mp4'
-                make_video(
-                    input_dir=output_frames_dir,
-                    output_filename=output_dir/output_video_name,
-                    frame_rate=output_frame_rate
-                )
+                if loop_finished:
+                    (output_frames_dir / LOOP_COMPLETE).touch()
+                timer.write(timings_file)
 
-            for que in reference_img_ques:
-                que.reset()
+            frame_saver.shutdown()
 
-        output_video_name = f'{timestamp}.mp4'
-        make_video(
-            input_dir=output_frames_dir,
-            output_filename=output_dir / output_video_name,
-            frame_rate=output_frame_rate
-        )
+            output_video_name = f'{timestamp}.mp4'
+            if streamed_video is None:
+                with timer.stage('make_video'):
+                    make_video(
+                        input_dir=output_frames_dir,
+                        output_filename=output_dir / output_video_name,
+                        frame_rate=output_frame_rate
+                    )
+            elif streamed_video != output_dir / output_video_name:
+                shutil.copyfile(streamed_video, output_dir / output_video_name)
+        finally:
+            # an error must not leave ffmpeg processes or threads behind in the webui
+            if video_writer is not None:
+                video_writer.close()
+            if frame_saver is not None:
+                try:
+                    frame_saver.shutdown()
+                except Exception as e:
+                    print(f"Exception occurred: {type(e).__name__} - {str(e)}")
+            if prefetch_executor is not None:
+                prefetch_executor.shutdown(wait=True, cancel_futures=True)
+            if input_reader is not None:
+                input_reader.close()
+
+        timer.write(timings_file)
 
         print(f"\n {timestamp} finished! now time:{get_now_time()}\n")
         shared.state.end()
 
+        if processed is None:
+            # every frame may have been generated by the workers
+            processed = Processed(p, [])
         return processed
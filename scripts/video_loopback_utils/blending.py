@@ -0,0 +1,136 @@
+from collections import OrderedDict
+from typing import Iterable, Sequence
+
+import numpy as np
+from PIL import Image, ImageChops
+
+# modes that map to uint8 arrays and back without loss
+ARRAY_MODES = {'L', 'LA', 'RGB', 'RGBA'}
+
+
+def stack_images(imgs: Sequence[Image.Image], mode=None) -> np.ndarray:
+    """Stacks images of the same size into a float32 array of shape (N, H, W[, C])."""
+    mode = mode or imgs[0].mode
+    return np.stack([
+        np.asarray(img if img.mode == mode else img.convert(mode), dtype=np.float32)
+        for img in imgs
+    ])
+
+
+def to_image(arr: np.ndarray) -> Image.Image:
+    return Image.fromarray(np.clip(np.rint(arr), 0, 255).astype(np.uint8))
+
+
+def blend_weighted(imgs: Iterable[Image.Image], weights: Iterable[float]) -> Image.Image:
+    """Weighted average of images, computed in float32 and rounded once.
+
+    Images are converted to the mode of the first one and the weights are
+    normalized. For non-negative weights this is what chaining
+    ``Image.blend`` with factor ``w_i / sum(w_0..w_i)`` approximates.
+    """
+    imgs = list(imgs)
+    weights = np.asarray(list(weights)[:len(imgs)], dtype=np.float32)
+    imgs = imgs[:len(weights)]
+    total = float(weights.sum())
+    if total <= 0 or len(imgs) == 1:
+        return imgs[0].copy()
+
+    mode = imgs[0].mode
+    if mode not in ARRAY_MODES:
+        mode = 'RGBA' if 'A' in imgs[0].getbands() else 'RGB'
+    stacked = stack_images(imgs, mode)
+    return to_image(np.tensordot(weights / total, stacked, axes=1))
+
+
+def blend_average(imgs: Iterable[Image.Image]) -> Image.Image:
+    imgs = list(imgs)
+    return blend_weighted(imgs, [1.0] * len(imgs))
+
+
+def blend_alpha(a: np.ndarray, b: np.ndarray, alpha: float) -> np.ndarray:
+    """``Image.blend`` over uint8 arrays of the same shape, for a whole batch at once.
+
+    Like Pillow it computes ``a + alpha * (b - a)`` in float32 and truncates.
+    """
+    alpha = np.float32(alpha)
+    out = a.astype(np.float32)
+    out += alpha * (b.astype(np.float32) - out)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def difference_luma(a: Image.Image, b: Image.Image) -> np.ndarray:
+    """Same values as ``ImageChops.difference(a, b).convert('L')``, as an int32 array."""
+    if a.mode == b.mode and a.mode in ('RGB', 'RGBA'):
+        diff = np.abs(
+            np.asarray(a, dtype=np.int32)[..., :3] - np.asarray(b, dtype=np.int32)[..., :3])
+        # ITU-R 601-2 luma with Pillow's fixed point rounding
+        return (diff[..., 0] * 19595 + diff[..., 1] * 38470 + diff[..., 2] * 7471
+                + 0x8000) >> 16
+    if a.mode == b.mode == 'L':
+        return np.abs(np.asarray(a, dtype=np.int32) - np.asarray(b, dtype=np.int32))
+    return np.asarray(ImageChops.difference(a, b).convert('L'), dtype=np.int32)
+
+
+class DifferenceMaskCache:
+    """Caches where two frames differ, keyed on the pair of images.
+
+    The difference is symmetric, so the pair of frames (i, j) computed for
+    the window of frame i is reused for the window of frame j. The images
+    are kept with their mask, which keeps the ids in the key unique.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._masks = OrderedDict()
+
+    def get(self, a: Image.Image, b: Image.Image) -> np.ndarray:
+        key = (id(a), id(b)) if id(a) <= id(b) else (id(b), id(a))
+        entry = self._masks.get(key)
+        if entry is not None:
+            self._masks.move_to_end(key)
+            return entry[2]
+        changed = difference_luma(a, b) > 0
+        self._masks[key] = (a, b, changed)
+        while len(self._masks) > self.max_size:
+            self._masks.popitem(last=False)
+        return changed
+
+    def clear(self):
+        self._masks.clear()
+
+
+def blend_difference_masked(
+        current_img: Image.Image,
+        imgs: Sequence[Image.Image],
+        alphas: Sequence[float],
+        reference_img: Image.Image,
+        reference_imgs: Sequence[Image.Image],
+        mask_cache: DifferenceMaskCache) -> Image.Image:
+    """Batched version of averaging ``Image.composite(current_img, img, mask)``.
+
+    For every frame of the window, ``mask`` is 255 where its reference frame
+    differs from the current reference frame and ``255 * (1 - alpha)``
+    elsewhere, the same masks as the ``point`` lambda of the PIL path.
+    """
+    n = min(len(imgs), len(alphas), len(reference_imgs))
+    size = (current_img.size[1], current_img.size[0])
+
+    masks = np.empty((n,) + size, dtype=np.float32)
+    for k in range(n):
+        keep = min(max(round(255 * (1 - alphas[k])), 0), 255)
+        changed = mask_cache.get(reference_img, reference_imgs[k])
+        mask = np.where(changed, np.uint8(255), np.uint8(keep))
+        if mask.shape != size:
+            mask = np.asarray(
+                Image.fromarray(mask).resize(current_img.size, Image.LANCZOS))
+        masks[k] = mask
+    masks /= 255
+
+    mode = current_img.mode
+    stacked = stack_images(imgs[:n], mode)
+    current = np.asarray(current_img, dtype=np.float32)
+    if stacked.ndim == 4:
+        masks = masks[..., None]
+    # composite: current where the mask is 255, the window frame where it is 0
+    output = (stacked + (current - stacked) * masks).mean(axis=0)
+    return to_image(output)
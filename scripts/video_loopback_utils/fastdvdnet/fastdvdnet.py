@@ -32,7 +32,19 @@ def temp_denoise(model, noisyframe, sigma_noise):
 
 	return out
 
-def denoise_seq_fastdvdnet(seq, noise_std, temp_psz, model_temporal):
+def pad_to_multiple(x, multiple=4):
+	'''Reflect-pads the last two dimensions of x up to a multiple of multiple,
+		like temp_denoise does for a single window
+	'''
+	sh_im = x.size()
+	expanded_h = -sh_im[-2] % multiple
+	expanded_w = -sh_im[-1] % multiple
+	if expanded_h or expanded_w:
+		x = F.pad(input=x, pad=(0, expanded_w, 0, expanded_h), mode='reflect')
+	return x, expanded_h, expanded_w
+
+def denoise_seq_fastdvdnet(seq, noise_std, temp_psz, model_temporal, batch_size=1, \
+						   reuse_first_stage=False, tile_size=0, tile_overlap=32):
 	r"""Denoises a sequence of frames with FastDVDnet.
 
 	Args:
@@ -40,12 +52,29 @@ def denoise_seq_fastdvdnet(seq, noise_std, temp_psz, model_temporal):
 		noise_std: Tensor. Standard deviation of the added noise
 		temp_psz: size of the temporal patch
 		model_temp: instance of the PyTorch model of the temporal denoiser
+		batch_size: number of central frames denoised per forward call. If larger
+			than one, see denoise_padded_seq_fastdvdnet
+		reuse_first_stage: compute every first stage triplet once for the whole
+			sequence, see denoise_padded_seq_fastdvdnet
+		tile_size: if larger than zero, frames bigger than tile_size are denoised
+			in overlapping tiles, see denoise_tiled_seq_fastdvdnet
+		tile_overlap: overlap of neighbouring tiles in pixels
 	Returns:
 		denframes: Tensor, [numframes, C, H, W]
 	"""
 	# init arrays to handle contiguous frames and related patches
 	numframes, C, H, W = seq.shape
 	ctrlfr_idx = int((temp_psz-1)//2)
+
+	if batch_size > 1 or reuse_first_stage or tile_size > 0:
+		# pad the whole sequence in time once, with the same reflection as below
+		padidx = torch.tensor([reflect_index(idx, numframes) \
+			for idx in range(-ctrlfr_idx, numframes+ctrlfr_idx)], device=seq.device)
+		return denoise_padded_seq_fastdvdnet(seq.index_select(0, padidx), \
+			noise_std, temp_psz, model_temporal, batch_size=batch_size, \
+			reuse_first_stage=reuse_first_stage, tile_size=tile_size, \
+			tile_overlap=tile_overlap)
+
 	inframes = list()
 	denframes = torch.empty((numframes, C, H, W)).to(seq.device)
 
@@ -76,3 +105,194 @@ def denoise_seq_fastdvdnet(seq, noise_std, temp_psz, model_temporal):
 
 	# convert to appropiate type and return
 	return denframes
+
+def reflect_index(idx, numframes):
+	'''Maps a frame index outside [0, numframes) back into the sequence,
+		with the same border handling as denoise_seq_fastdvdnet
+	'''
+	if idx < 0:
+		return -idx
+	if idx > numframes-1:
+		return 2*(numframes-1) - idx
+	return idx
+
+def denoise_padded_seq_fastdvdnet(seqp, noise_std, temp_psz, model_temporal, batch_size=1, \
+								  reuse_first_stage=False, tile_size=0, tile_overlap=32):
+	r"""Denoises the central frames of a sequence that is already padded in time.
+
+	The sequence is padded spatially once, and the input of every forward call
+	is a strided view over it holding batch_size consecutive windows, so
+	building the windows copies nothing.
+
+	Args:
+		seqp: Tensor. [numframes+temp_psz-1, C, H, W] array containing the noisy
+			input frames, with (temp_psz-1)//2 extra frames on both sides
+		noise_std: Tensor. Standard deviation of the added noise
+		temp_psz: size of the temporal patch
+		model_temp: instance of the PyTorch model of the temporal denoiser
+		batch_size: number of central frames denoised per forward call
+		reuse_first_stage: run the model stage by stage, see
+			denoise_first_stage_reuse
+		tile_size: if larger than zero, frames bigger than tile_size are denoised
+			in overlapping tiles, see denoise_tiled_seq_fastdvdnet
+		tile_overlap: overlap of neighbouring tiles in pixels
+	Returns:
+		denframes: Tensor, [numframes, C, H, W]
+	"""
+	numframes = seqp.shape[0] - temp_psz + 1
+	_, C, H, W = seqp.shape
+	if tile_size > 0 and (H > tile_size or W > tile_size):
+		return denoise_tiled_seq_fastdvdnet(seqp, noise_std, temp_psz, model_temporal, \
+			tile_size, tile_overlap, batch_size=batch_size, \
+			reuse_first_stage=reuse_first_stage)
+	denframes = torch.empty((numframes, C, H, W)).to(seqp.device)
+
+	# make size a multiple of four (we have two scales in the denoiser)
+	seqp, _, _ = pad_to_multiple(seqp.contiguous(), 4)
+	Hp, Wp = seqp.shape[-2:]
+	frame_stride = C*Hp*Wp
+
+	# build noise map from noise std---assuming Gaussian noise. It is constant,
+	# so building it at the padded size equals padding it
+	noise_map = noise_std.expand((1, 1, Hp, Wp))
+
+	if reuse_first_stage:
+		denoise_first_stage_reuse(seqp, noise_map, model_temporal, denframes, batch_size)
+		return denframes
+
+	for fridx in range(0, numframes, batch_size):
+		nbatch = min(batch_size, numframes-fridx)
+		# window b starts one frame after window b-1
+		inframes_t = seqp.as_strided((nbatch, temp_psz*C, Hp, Wp), \
+			(frame_stride, Hp*Wp, Wp, 1), seqp.storage_offset() + fridx*frame_stride)
+		out = torch.clamp(model_temporal(inframes_t, \
+			noise_map.expand((nbatch, 1, Hp, Wp))), 0., 1.)
+		denframes[fridx:fridx+nbatch] = out[:, :, :H, :W]
+
+	return denframes
+
+def denoise_first_stage_reuse(seqp, noise_map, model_temporal, denframes, batch_size=1):
+	r"""Denoises a padded sequence computing each first stage triplet once.
+
+	FastDVDnet.forward runs temp1 on the frame triplets (0,1,2), (1,2,3) and
+	(2,3,4) of its window, and the window of the next frame shares two of them.
+	Here the temp1 output of the triplet starting at every frame is computed
+	once and kept in a rolling cache until temp2 of the last frame using it
+	has run, which halves the model evaluations. The calls and their inputs
+	are those of the per-frame path, but batched convolutions may use other
+	algorithms than single windows, so the output matches it within float
+	tolerance. fastdvdnet_export.check_first_stage_reuse measures the
+	difference for a model and a batch size.
+
+	Args:
+		seqp: Tensor. [numframes+4, C, Hp, Wp] noisy frames padded in time by
+			two frames and spatially to a multiple of four
+		noise_map: Tensor. [1, 1, Hp, Wp] noise map
+		model_temporal: FastDVDnet model, possibly wrapped in nn.DataParallel
+		denframes: Tensor, [numframes, C, H, W] where the result is written
+		batch_size: number of triplets and of central frames per call
+	"""
+	model = getattr(model_temporal, 'module', model_temporal)
+	assert getattr(model, 'num_input_frames', 5) == 5 # traced models lose the attribute
+	numframes, C, H, W = denframes.shape
+	_, _, Hp, Wp = seqp.shape
+	frame_stride = C*Hp*Wp
+
+	stage1 = list() # temp1 outputs, stage1[k] is the triplet starting at frame fridx+k
+	for fridx in range(0, numframes, batch_size):
+		nbatch = min(batch_size, numframes-fridx)
+
+		# compute the triplets of this batch not shared with the previous one
+		for tridx in range(fridx+len(stage1), fridx+nbatch+2, batch_size):
+			ntrip = min(batch_size, fridx+nbatch+2-tridx)
+			intrip = seqp.as_strided((ntrip, 3*C, Hp, Wp), \
+				(frame_stride, Hp*Wp, Wp, 1), seqp.storage_offset() + tridx*frame_stride)
+			out = model.temp1(intrip[:, 0:C], intrip[:, C:2*C], intrip[:, 2*C:3*C], \
+				noise_map.expand((ntrip, 1, Hp, Wp)))
+			stage1.extend(out.split(1, dim=0))
+
+		# second stage on three consecutive triplets
+		x = model.temp2(torch.cat(stage1[0:nbatch], dim=0), \
+			torch.cat(stage1[1:nbatch+1], dim=0), \
+			torch.cat(stage1[2:nbatch+2], dim=0), \
+			noise_map.expand((nbatch, 1, Hp, Wp)))
+		denframes[fridx:fridx+nbatch] = torch.clamp(x, 0., 1.)[:, :, :H, :W]
+
+		# only the last two triplets are shared with the next batch
+		del stage1[:nbatch]
+
+def tile_starts(length, tile_size, stride):
+	'''Start offsets of tiles of tile_size covering [0, length), the last tile
+		is moved back to end at length
+	'''
+	if length <= tile_size:
+		return [0]
+	starts = list(range(0, length-tile_size, stride))
+	starts.append(length-tile_size)
+	return starts
+
+def feather_ramp(tile_len, overlap, ramp_start, ramp_end, device):
+	'''1D blending weights of a tile, rising over the first overlap pixels and
+		falling over the last ones on the sides that overlap another tile
+	'''
+	w = torch.ones(tile_len, device=device)
+	n = min(overlap, tile_len)
+	if n > 0:
+		ramp = torch.arange(1, n+1, dtype=torch.float32, device=device) / (n+1)
+		if ramp_start:
+			w[:n] = torch.minimum(w[:n], ramp)
+		if ramp_end:
+			w[-n:] = torch.minimum(w[-n:], ramp.flip(0))
+	return w
+
+def denoise_tiled_seq_fastdvdnet(seqp, noise_std, temp_psz, model_temporal, tile_size, \
+								 tile_overlap=32, batch_size=1, reuse_first_stage=False):
+	r"""Denoises a padded sequence in overlapping spatial tiles.
+
+	The activations of the denoiser grow with the frame size, so large frames
+	are cut into tiles of at most tile_size x tile_size pixels which are
+	denoised one after the other with denoise_padded_seq_fastdvdnet. Each
+	tile is weighted by a ramp over the pixels it shares with its neighbours
+	and the weighted sum is normalized, so the seams are feathered. Tiles
+	see real image content across the overlap, a tile_overlap of a few tens
+	of pixels gives the denoiser enough context at the tile borders.
+
+	Args:
+		seqp: Tensor. [numframes+temp_psz-1, C, H, W] array containing the noisy
+			input frames, with (temp_psz-1)//2 extra frames on both sides
+		noise_std: Tensor. Standard deviation of the added noise
+		temp_psz: size of the temporal patch
+		model_temp: instance of the PyTorch model of the temporal denoiser
+		tile_size: largest height and width of a tile, rounded down to a
+			multiple of four
+		tile_overlap: overlap of neighbouring tiles in pixels
+		batch_size: number of central frames denoised per forward call
+		reuse_first_stage: see denoise_padded_seq_fastdvdnet
+	Returns:
+		denframes: Tensor, [numframes, C, H, W]
+	"""
+	numframes = seqp.shape[0] - temp_psz + 1
+	_, C, H, W = seqp.shape
+	tile_size = max(tile_size - tile_size%4, 8)
+	tile_overlap = max(min(tile_overlap, tile_size//2), 0)
+	stride = tile_size - tile_overlap
+
+	denframes = torch.zeros((numframes, C, H, W), device=seqp.device)
+	weights = torch.zeros((1, 1, H, W), device=seqp.device)
+	ys = tile_starts(H, tile_size, stride)
+	xs = tile_starts(W, tile_size, stride)
+	for y in ys:
+		th = min(tile_size, H)
+		wy = feather_ramp(th, tile_overlap, y > 0, y+th < H, seqp.device)
+		for x in xs:
+			tw = min(tile_size, W)
+			wx = feather_ramp(tw, tile_overlap, x > 0, x+tw < W, seqp.device)
+			w = (wy[:, None] * wx[None, :]).view(1, 1, th, tw)
+			tile = denoise_padded_seq_fastdvdnet(seqp[:, :, y:y+th, x:x+tw], \
+				noise_std, temp_psz, model_temporal, batch_size=batch_size, \
+				reuse_first_stage=reuse_first_stage)
+			denframes[:, :, y:y+th, x:x+tw] += tile * w
+			weights[:, :, y:y+th, x:x+tw] += w
+			del tile
+
+	return denframes / weights
@@ -20,7 +20,6 @@ import numpy as np
 import cv2
 import torch
 from skimage.metrics import peak_signal_noise_ratio as compare_psnr
-from tensorboardX import SummaryWriter
 
 IMAGETYPES = ('*.bmp', '*.png', '*.jpg', '*.jpeg', '*.tif') # Supported image types
 
@@ -75,6 +74,9 @@ def normalize_augment(datain, ctrl_fr_idx):
 def init_logging(argdict):
 	"""Initilizes the logging and the SummaryWriter modules
 	"""
+	# only needed for training, keep the inference path free of tensorboardX
+	from tensorboardX import SummaryWriter
+
 	if not os.path.exists(argdict['log_dir']):
 		os.makedirs(argdict['log_dir'])
 	writer = SummaryWriter(argdict['log_dir'])
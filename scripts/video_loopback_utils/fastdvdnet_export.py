@@ -0,0 +1,152 @@
+import argparse
+import copy
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+try:
+    from torch.ao.nn.intrinsic import ConvReLU2d
+except ImportError:  # torch < 1.13
+    from torch.nn.intrinsic import ConvReLU2d
+
+from .fastdvdnet.models import FastDVDnet as FastDVDnet_model
+from .fastdvdnet.fastdvdnet import denoise_seq_fastdvdnet
+from .fastdvdnet.utils import remove_dataparallel_wrapper
+
+
+def _fuse_sequential(seq: nn.Sequential):
+    layers = list(seq.children())
+    fused = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        if isinstance(layer, nn.Conv2d) and i + 1 < len(layers) \
+                and isinstance(layers[i + 1], nn.BatchNorm2d):
+            layer = fuse_conv_bn_eval(layer, layers[i + 1])
+            i += 1
+        if isinstance(layer, nn.Conv2d) and i + 1 < len(layers) \
+                and isinstance(layers[i + 1], nn.ReLU):
+            layer = ConvReLU2d(layer, nn.ReLU(inplace=True))
+            i += 1
+        fused.append(layer)
+        i += 1
+
+    for name in list(seq._modules):
+        del seq._modules[name]
+    for i, layer in enumerate(fused):
+        seq.add_module(str(i), layer)
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    """Returns an eval-mode copy of model with every BatchNorm2d folded into the
+    Conv2d before it and every Conv2d => ReLU pair fused into a ConvReLU2d."""
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            _fuse_sequential(module)
+    return model
+
+
+def example_inputs(num_input_frames=5, size=(96, 128), device='cpu', seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    height, width = size
+    x = torch.rand((1, 3 * num_input_frames, height, width), generator=generator)
+    noise_map = torch.full((1, 1, height, width), 25 / 255)
+    return x.to(device), noise_map.to(device)
+
+
+def check_equivalence(reference: nn.Module, optimized: nn.Module,
+                      num_input_frames=5, size=(96, 128), atol=1e-4) -> float:
+    """Compares both modules on random input, raises if they differ by more than atol."""
+    device = next(reference.parameters()).device
+    x, noise_map = example_inputs(num_input_frames, size, device)
+    with torch.no_grad():
+        max_diff = (reference.eval()(x, noise_map) - optimized(x, noise_map)).abs().max().item()
+    if max_diff > atol:
+        raise AssertionError(
+            f'optimized FastDVDnet differs from the original model by {max_diff:.3g}')
+    return max_diff
+
+
+def check_first_stage_reuse(model: nn.Module, batch_size=4, numframes=8,
+                            size=(96, 128), atol=1e-4, device=None, reference=None) -> float:
+    """Compares the first stage reuse of model at batch_size with the original
+    per-frame path of denoise_seq_fastdvdnet on random frames, raises if they
+    differ by more than atol. The per-frame path runs reference if given, model otherwise."""
+    if reference is None:
+        reference = model
+    if device is None:  # quantized models keep their weights out of parameters()
+        device = next(model.parameters()).device
+    generator = torch.Generator().manual_seed(0)
+    seq = torch.rand((numframes, 3) + tuple(size), generator=generator).to(device)
+    noise_std = torch.FloatTensor([25 / 255]).to(device)
+    with torch.no_grad():
+        per_frame = denoise_seq_fastdvdnet(seq, noise_std, 5, reference)
+        reused = denoise_seq_fastdvdnet(
+            seq, noise_std, 5, model, batch_size=batch_size, reuse_first_stage=True)
+    max_diff = (per_frame.float() - reused.float()).abs().max().item()
+    if max_diff > atol:
+        raise AssertionError(
+            f'first stage reuse with batch_size={batch_size} differs '
+            f'from the per-frame path by {max_diff:.3g}')
+    return max_diff
+
+
+def export_fused_model(model: FastDVDnet_model) -> nn.Module:
+    """Folds model on CPU and checks the result against it, through forward
+    and through the first stage reuse. The result stays an eager module, so
+    temp1 and temp2 can be called on their own."""
+    model = copy.deepcopy(model).cpu().eval()
+    fused = fold_batchnorm(model)
+    check_equivalence(model, fused, model.num_input_frames)
+    if model.num_input_frames == 5:
+        check_first_stage_reuse(fused, reference=model)
+    return fused
+
+
+def fused_model_path(model_path: Path, temporal_size=5) -> Path:
+    model_path = Path(model_path)
+    return model_path.with_name(f'{model_path.stem}_fused_t{temporal_size}.pth')
+
+
+def load_fused_model(model: FastDVDnet_model, model_path: Path, device,
+                     temporal_size=5) -> nn.Module:
+    """Loads the folded weights cached next to model_path, exporting them
+    first if they are missing or older than the checkpoint."""
+    cache_path = fused_model_path(model_path, temporal_size)
+    if not cache_path.is_file() \
+            or cache_path.stat().st_mtime < Path(model_path).stat().st_mtime:
+        print(f'Exporting fused FastDVDnet to "{cache_path}"')
+        torch.save(export_fused_model(model).state_dict(), str(cache_path))
+    # folding gives the layout of the cached weights, which then replace the folded ones
+    fused = fold_batchnorm(model)
+    fused.load_state_dict(torch.load(str(cache_path), map_location='cpu'))
+    fused.to(device).eval()
+    return fused
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export FastDVDnet with BatchNorm folded and check it against the original')
+    parser.add_argument('--model_file', type=str,
+                        default=str(Path(__file__).parent / 'fastdvdnet' / 'model.pth'))
+    parser.add_argument('--temporal_size', type=int, default=5)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help='batch size of the first stage reuse check')
+    args = parser.parse_args()
+
+    reference = FastDVDnet_model(num_input_frames=args.temporal_size)
+    reference.load_state_dict(remove_dataparallel_wrapper(
+        torch.load(args.model_file, map_location='cpu')))
+    reference.eval()
+    fused = load_fused_model(reference, Path(args.model_file), 'cpu', args.temporal_size)
+    print(f'max abs difference: '
+          f'{check_equivalence(reference, fused, args.temporal_size, atol=args.atol):.3g}')
+    for name, model in (('original', reference), ('fused', fused)):
+        # the per-frame path of the original model is the reference of both
+        max_diff = check_first_stage_reuse(
+            model, args.batch_size, atol=args.atol, reference=reference)
+        print(f'first stage reuse of the {name} model, max abs difference: {max_diff:.3g}')
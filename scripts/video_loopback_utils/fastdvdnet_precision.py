@@ -0,0 +1,267 @@
+import argparse
+import copy
+import json
+import sys
+from contextlib import nullcontext
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .fastdvdnet.models import FastDVDnet as FastDVDnet_model
+from .fastdvdnet.utils import remove_dataparallel_wrapper, batch_psnr
+from .fastdvdnet.fastdvdnet import denoise_seq_fastdvdnet, reflect_index
+from .fastdvdnet_export import load_fused_model, example_inputs
+
+# reference frames are listed here, .utils imports the webui and this module also runs on its own
+REFERENCE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tif', '.tiff'}
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+def autocast(precision, device):
+    """bf16 runs the fp32 model under autocast, the other modes need nothing."""
+    if precision != 'bf16':
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+def int8_model_paths(model_path: Path, temporal_size=5) -> Tuple[Path, Path]:
+    """Files of the traced temp1 and temp2 of the int8 model."""
+    model_path = Path(model_path)
+    return tuple(
+        model_path.with_name(f'{model_path.stem}_int8_t{temporal_size}_{stage}.pt')
+        for stage in ('temp1', 'temp2'))
+
+
+def validation_path(model_path: Path) -> Path:
+    model_path = Path(model_path)
+    return model_path.with_name(f'{model_path.stem}_precision.json')
+
+
+def validation_key(precision, temporal_size=5, fused=False) -> str:
+    # int8 runs its own model, bf16 the fused or the original one
+    if precision == 'bf16' and fused:
+        return f'{precision}_t{temporal_size}_fused'
+    return f'{precision}_t{temporal_size}'
+
+
+def load_validation(model_path: Path) -> dict:
+    path = validation_path(model_path)
+    if not path.is_file():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def validated_precision(model_path: Path, precision, temporal_size=5, fused=False) -> Optional[dict]:
+    """Returns the validation record of precision if it passed for the
+    current checkpoint and the model FastDVDNet runs, None otherwise.
+    fp32 needs no validation."""
+    if precision == 'fp32':
+        return {}
+    record = load_validation(model_path).get(validation_key(precision, temporal_size, fused))
+    if record is None or not record['passed'] \
+            or record['model_mtime'] != Path(model_path).stat().st_mtime:
+        return None
+    if precision == 'int8' and \
+            not all(p.is_file() for p in int8_model_paths(model_path, temporal_size)):
+        return None
+    return record
+
+
+def save_validation(model_path: Path, precision, temporal_size, record: dict, fused=False):
+    records = load_validation(model_path)
+    records[validation_key(precision, temporal_size, fused)] = record
+    with open(validation_path(model_path), 'w', encoding='utf-8') as f:
+        json.dump(records, f, indent=4)
+
+
+def window_inputs(seq: torch.Tensor, noise_std: torch.Tensor, temporal_size=5) \
+        -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """(x, noise_map) of every window of seq, reflected at the ends."""
+    frame_n, _, height, width = seq.shape
+    hws = temporal_size // 2
+    noise_map = noise_std.expand((1, 1, height, width))
+    windows = []
+    for i in range(frame_n):
+        indices = [reflect_index(j, frame_n) for j in range(i - hws, i + hws + 1)]
+        windows.append((seq[indices].reshape(1, -1, height, width), noise_map))
+    return windows
+
+
+def quantize_int8(model: FastDVDnet_model, calibration: List[Tuple[torch.Tensor, torch.Tensor]]) \
+        -> FastDVDnet_model:
+    """Statically quantizes both denoising stages with FX and traces each of them.
+
+    The stages are quantized and traced separately, and the result is an
+    eager FastDVDnet holding them, so temp1 and temp2 can be called on their
+    own and the first stage reuse still works. A trace of the whole model
+    would not allow that. Quantized kernels only run on CPU.
+    """
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    except ImportError:
+        raise RuntimeError('int8 FastDVDnet needs torch >= 1.13')
+
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_mapping = get_default_qconfig_mapping('fbgemm')
+    x, noise_map = calibration[0]
+    frames = x[:, :9].split(3, dim=1)
+    example = (frames[0], frames[1], frames[2], noise_map)
+    model.temp1 = prepare_fx(model.temp1, qconfig_mapping, example)
+    model.temp2 = prepare_fx(model.temp2, qconfig_mapping, example)
+    with torch.no_grad():
+        for x, noise_map in calibration:
+            model(x, noise_map)
+    model.temp1 = convert_fx(model.temp1)
+    model.temp2 = convert_fx(model.temp2)
+    with torch.no_grad():
+        # the input of temp2 has the shape of a frame as well
+        model.temp1 = torch.jit.trace(model.temp1, example)
+        model.temp2 = torch.jit.trace(model.temp2, example)
+    return model
+
+
+def save_int8_model(model: FastDVDnet_model, model_path: Path, temporal_size=5):
+    temp1_path, temp2_path = int8_model_paths(model_path, temporal_size)
+    torch.jit.save(model.temp1, str(temp1_path))
+    torch.jit.save(model.temp2, str(temp2_path))
+
+
+def load_int8_model(model_path: Path, temporal_size=5) -> FastDVDnet_model:
+    temp1_path, temp2_path = int8_model_paths(model_path, temporal_size)
+    model = FastDVDnet_model(num_input_frames=temporal_size)
+    model.temp1 = torch.jit.load(str(temp1_path), map_location='cpu')
+    model.temp2 = torch.jit.load(str(temp2_path), map_location='cpu')
+    model.eval()
+    return model
+
+
+def load_reference_sequence(frames_dir, max_frames=16, max_size=512) -> torch.Tensor:
+    frames = []
+    paths = sorted(
+        (p for p in Path(frames_dir).iterdir()
+         if p.suffix.lower() in REFERENCE_EXTENSIONS and not p.name.startswith('.')),
+        key=lambda p: p.name.lower()
+    )
+    for path in paths[:max_frames]:
+        img = Image.open(path).convert('RGB')
+        img.thumbnail((max_size, max_size))
+        frames.append(np.asarray(img))
+    seq = np.stack(frames, axis=0).transpose(0, 3, 1, 2).astype(np.float32) / 255.
+    # the denoiser works on sizes divisible by four
+    height, width = seq.shape[-2] // 4 * 4, seq.shape[-1] // 4 * 4
+    return torch.from_numpy(seq[:, :, :height, :width].copy())
+
+
+def autocast_effective(model, temporal_size=5) -> bool:
+    """Whether bf16 autocast changes the output of model on CPU, traced
+    models may keep running their recorded fp32 kernels."""
+    x, noise_map = example_inputs(temporal_size, size=(32, 32))
+    with torch.no_grad():
+        fp32 = model(x, noise_map)
+        with autocast('bf16', 'cpu'):
+            bf16 = model(x, noise_map)
+    return bf16.dtype != fp32.dtype or not torch.equal(bf16, fp32)
+
+
+def denoise_psnr(model, seq, seqn, noise_std, temporal_size, precision='fp32') -> float:
+    with torch.no_grad(), autocast(precision, 'cpu'):
+        denframes = denoise_seq_fastdvdnet(
+            seq=seqn,
+            noise_std=noise_std,
+            temp_psz=temporal_size,
+            model_temporal=model,
+            reuse_first_stage=True
+        )
+    return batch_psnr(denframes.float().clamp(0., 1.), seq, 1.)
+
+
+def validate_precision(model_path: Path, frames_dir, precisions, temporal_size=5,
+                       noise_sigma=60, max_psnr_drop=0.5, max_frames=16, max_size=512,
+                       fused=True) -> bool:
+    """Denoises a clean reference sequence with noise added in fp32 and in each
+    precision, and accepts a precision if its PSNR is at most max_psnr_drop dB
+    below fp32. bf16 is measured on the model FastDVDNet runs with ``fused``,
+    and refused if autocast does not reach it. Accepted int8 models are saved
+    next to the checkpoint, and every result is recorded so FastDVDNet only
+    runs validated modes."""
+    model_path = Path(model_path)
+    model = FastDVDnet_model(num_input_frames=temporal_size)
+    model.load_state_dict(remove_dataparallel_wrapper(
+        torch.load(model_path, map_location='cpu')))
+    model.eval()
+
+    seq = load_reference_sequence(frames_dir, max_frames, max_size)
+    noise_std = torch.FloatTensor([noise_sigma / 255])
+    generator = torch.Generator().manual_seed(0)
+    seqn = seq + torch.empty_like(seq).normal_(mean=0, std=noise_std.item(), generator=generator)
+    fp32_psnr = denoise_psnr(model, seq, seqn, noise_std, temporal_size)
+    print(f'fp32: {fp32_psnr:.2f} dB')
+
+    all_passed = True
+    for precision in precisions:
+        if precision == 'fp32':
+            continue
+        candidate = model
+        effective = True
+        if precision == 'bf16' and fused:
+            candidate = load_fused_model(model, model_path, 'cpu', temporal_size)
+        if precision == 'bf16':
+            effective = autocast_effective(candidate, temporal_size)
+        if precision == 'int8':
+            # calibrate on noise other than the one validated against
+            calibration_seqn = seq + torch.empty_like(seq).normal_(
+                mean=0, std=noise_std.item(), generator=generator)
+            candidate = quantize_int8(
+                model, window_inputs(calibration_seqn, noise_std, temporal_size))
+        psnr = denoise_psnr(candidate, seq, seqn, noise_std, temporal_size, precision)
+        drop = fp32_psnr - psnr
+        passed = drop <= max_psnr_drop and effective
+        all_passed &= passed
+        print(f'{precision}{" (fused)" if precision == "bf16" and fused else ""}: '
+              f'{psnr:.2f} dB, {drop:+.2f} dB below fp32, '
+              f'{"accepted" if passed else "refused"}'
+              f'{"" if effective else ", autocast has no effect on this model"}')
+        if passed and precision == 'int8':
+            save_int8_model(candidate, model_path, temporal_size)
+        save_validation(model_path, precision, temporal_size, {
+            'passed': passed,
+            'psnr': psnr,
+            'fp32_psnr': fp32_psnr,
+            'psnr_drop': drop,
+            'max_psnr_drop': max_psnr_drop,
+            'noise_sigma': noise_sigma,
+            'fused': fused and precision == 'bf16',
+            'autocast_effective': effective,
+            'reference': str(Path(frames_dir).absolute()),
+            'model_mtime': model_path.stat().st_mtime
+        }, fused=fused)
+    return all_passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Validate reduced precision FastDVDnet modes against fp32 on a reference sequence')
+    parser.add_argument('frames_dir', type=str, help='directory of clean reference frames')
+    parser.add_argument('--precision', type=str, nargs='+', default=['bf16', 'int8'],
+                        choices=PRECISIONS)
+    parser.add_argument('--model_file', type=str,
+                        default=str(Path(__file__).parent / 'fastdvdnet' / 'model.pth'))
+    parser.add_argument('--temporal_size', type=int, default=5)
+    parser.add_argument('--noise_sigma', type=float, default=60)
+    parser.add_argument('--max_psnr_drop', type=float, default=0.5)
+    parser.add_argument('--max_frames', type=int, default=16)
+    parser.add_argument('--max_size', type=int, default=512)
+    parser.add_argument('--unfused', action='store_true',
+                        help='validate bf16 for fastdvdnet_fused off instead of on')
+    args = parser.parse_args()
+
+    sys.exit(0 if validate_precision(
+        args.model_file, args.frames_dir, args.precision, args.temporal_size,
+        args.noise_sigma, args.max_psnr_drop, args.max_frames, args.max_size,
+        fused=not args.unfused) else 1)
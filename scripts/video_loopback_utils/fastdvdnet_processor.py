@@ -1,58 +1,307 @@
 from pathlib import Path
+from typing import Dict, Tuple
 from PIL import Image
 
 import torch
-import torch.nn as nn
 import numpy as np
 from .fastdvdnet.models import FastDVDnet as FastDVDnet_model
-from .fastdvdnet.fastdvdnet import denoise_seq_fastdvdnet
-from .utils import get_image_paths
+from .fastdvdnet.utils import remove_dataparallel_wrapper
+from .fastdvdnet_export import load_fused_model, check_first_stage_reuse
+from .fastdvdnet_precision import PRECISIONS, autocast, validated_precision, \
+    load_int8_model
+from .fastdvdnet.fastdvdnet import denoise_seq_fastdvdnet, \
+    denoise_padded_seq_fastdvdnet, reflect_index
+from .utils import get_image_paths, save_image_atomic
+from .blending import blend_alpha
+from .frame_saver import AsyncFrameSaver
 
 # sed -i "22c from skimage.metrics import peak_signal_noise_ratio as compare_psnr" ./fastdvdnet/utils.py
 
+DEFAULT_MODEL_PATH = Path(__file__).parent/'fastdvdnet'/'model.pth'
+# frames are written as uint8, smaller differences do not change them
+REUSE_ATOL = 0.5 / 255
+
+
+def resolve_device(device) -> torch.device:
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def loaded_precision(model_path, precision, temporal_size, device: torch.device, fused=False) \
+        -> Tuple[str, Optional[str]]:
+    """The precision FastDVDNet runs when precision is requested, and why it
+    falls back to fp32 if it does."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'unknown FastDVDNet precision: {precision}')
+    if precision == 'int8' and device.type != 'cpu':
+        return 'fp32', 'int8 FastDVDNet only runs on CPU'
+    if validated_precision(model_path, precision, temporal_size, fused) is None:
+        # see fastdvdnet_precision.py, run it again after changing the checkpoint
+        return 'fp32', f'FastDVDNet {precision} has not passed validation for "{model_path}"'
+    return precision, None
+
 
 class FastDVDNet:
+    """Denoises the frames of a loop in place with FastDVDnet.
+
+    Only the model is held here, per-call options are arguments of
+    ``process``. Use ``get_fastdvdnet`` to reuse a loaded model between runs.
+    """
+
     def __init__(
-            self, alpha, noise_sigma=60,
-            model_path=Path(__file__).parent/'fastdvdnet'/'model.pth',
-            temporal_size=5):
-        assert torch.cuda.is_available()
-        print("Loading FastDVDNet: ", model_path.absolute(), model_path.exists())
-        self.device = torch.device('cuda')
-        self.alpha = alpha
-        self.noise_sigma = noise_sigma / 255
+            self,
+            model_path=DEFAULT_MODEL_PATH,
+            temporal_size=5,
+            device='cuda', precision='fp32', channels_last=None, fused=False):
+        model_path = Path(model_path)
+        self.device = resolve_device(device)
+        if self.device.type == 'cuda':
+            assert torch.cuda.is_available()
+        precision, reason = loaded_precision(
+            model_path, precision, temporal_size, self.device, fused)
+        if reason is not None:
+            print(f'Warning: {reason}, using fp32')
+        print("Loading FastDVDNet: ", model_path.absolute(), model_path.exists(),
+              "device:", self.device, "precision:", precision)
         self.temporal_size = temporal_size
-        device_ids = [0]
+        self.precision = precision
+        if channels_last is None:
+            channels_last = self.device.type == 'cpu' and precision != 'int8'
+
+        # the checkpoint was saved from nn.DataParallel
         model_temp = FastDVDnet_model(num_input_frames=temporal_size)
-        model_temp = nn.DataParallel(model_temp, device_ids=device_ids).cuda()
-        model_temp.load_state_dict(torch.load(model_path))
+        state_dict = torch.load(model_path, map_location='cpu')
+        model_temp.load_state_dict(remove_dataparallel_wrapper(state_dict))
+        model_temp.eval()
+        if precision == 'int8':
+            # calibrated and traced by fastdvdnet_precision.py
+            model_temp = load_int8_model(model_path, temporal_size)
+        elif fused:
+            # BatchNorm folded into the convolutions, cached next to the checkpoint
+            model_temp = load_fused_model(
+                model_temp, model_path, self.device, temporal_size)
+        model_temp = model_temp.to(self.device)
+        if channels_last:
+            # convolutions follow the memory format of the weights
+            model_temp = model_temp.to(memory_format=torch.channels_last)
         model_temp.eval()
         self.model = model_temp
+        self._reuse_checked: Dict[int, bool] = {}  # batch_size -> first stage reuse is exact enough
 
-    def process(self, input_path):
+    def first_stage_reuse_ok(self, batch_size) -> bool:
+        """Checks the first stage reuse against the per-frame path once per batch size.
+        Any failure of the check, not only a difference, disables the reuse."""
+        if batch_size not in self._reuse_checked:
+            try:
+                with autocast(self.precision, self.device):
+                    check_first_stage_reuse(
+                        self.model, batch_size, atol=REUSE_ATOL, device=self.device)
+                self._reuse_checked[batch_size] = True
+            except Exception as e:
+                print(f'Warning: first stage reuse is unavailable, denoising frame by frame: '
+                      f'{type(e).__name__} - {e}')
+                self._reuse_checked[batch_size] = False
+        return self._reuse_checked[batch_size]
+
+    def process(
+            self, input_path, alpha, noise_sigma=60,
+            chunk_size=0, batch_size=1, reuse_first_stage=True, num_threads=0,
+            tile_size=0, tile_overlap=32, save_workers=4, output_path=None):
+        """
+        alpha: blend factor of the denoised frames
+        noise_sigma: noise level in [0, 255]
+        chunk_size: frames denoised at once, 0 for the whole sequence
+        batch_size: central frames per forward call
+        reuse_first_stage: compute the first stage of neighbouring frames once
+        num_threads: intra-op threads used while denoising, 0 to keep torch's setting
+        tile_size: frames larger than this are denoised in overlapping tiles, 0 to disable
+        tile_overlap: overlap of neighbouring tiles in pixels
+        save_workers: threads encoding the blended frames
+        output_path: directory the blended frames are written to, None to overwrite the input
+        """
         image_paths = get_image_paths(input_path)
+        output_paths = image_paths if output_path is None else \
+            [Path(output_path) / p.name for p in image_paths]
+        noise_sigma = noise_sigma / 255
+        batch_size = max(batch_size, 1)
+        reuse_first_stage = reuse_first_stage and self.first_stage_reuse_ok(batch_size)
+        previous_num_threads = torch.get_num_threads()
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        # frames are overwritten in place, a crash must not leave them half written
+        saver = AsyncFrameSaver(
+            max_workers=max(save_workers, 1), max_pending=2*max(save_workers, 1), atomic=True)
+        try:
+            with autocast(self.precision, self.device):
+                if chunk_size > 0:
+                    self.process_chunked(
+                        image_paths, alpha, noise_sigma,
+                        max(chunk_size, self.temporal_size),
+                        batch_size, reuse_first_stage, tile_size, tile_overlap, saver,
+                        output_paths)
+                else:
+                    self.process_all(
+                        image_paths, alpha, noise_sigma,
+                        batch_size, reuse_first_stage, tile_size, tile_overlap, saver,
+                        output_paths)
+        finally:
+            torch.set_num_threads(previous_num_threads)
+            saver.shutdown()
+
+    @staticmethod
+    def write_back(originals, denframes, paths, alpha, saver, batch_size=16):
+        """Blends the denoised uint8 frames (N, H, W, 3) over the originals
+        and saves them on saver, or right away without one. RGB and RGBA
+        sequences are blended as arrays, batch_size frames at a time, other
+        modes frame by frame. The alpha channel of the originals is kept,
+        it can be the mask of the next loop."""
+        submit = saver.submit if saver is not None else save_image_atomic
+        mode = originals[0].mode
+        if mode not in ('RGB', 'RGBA') or \
+                any(o.mode != mode or o.size != originals[0].size for o in originals):
+            for o_img, p_img, p in zip(originals, denframes, paths):
+                p_img = Image.fromarray(p_img).convert(o_img.mode)
+                img = Image.blend(o_img, p_img, alpha)
+                if 'A' in o_img.getbands():
+                    img.putalpha(o_img.getchannel('A'))
+                submit(img, p)
+            return
+
+        for start in range(0, len(originals), batch_size):
+            stop = start + batch_size
+            o_arr = np.stack([np.asarray(o) for o in originals[start:stop]])
+            p_arr = denframes[start:stop]
+            out = blend_alpha(o_arr[..., :3], p_arr, alpha)
+            if mode == 'RGBA':
+                out = np.concatenate([out, o_arr[..., 3:]], axis=-1)
+            for arr, p in zip(out, paths[start:stop]):
+                submit(Image.fromarray(arr, mode), p)
+
+    def process_all(
+            self, image_paths, alpha, noise_sigma,
+            batch_size=1, reuse_first_stage=True, tile_size=0, tile_overlap=32,
+            saver=None, output_paths=None):
         seq_images = [Image.open(p) for p in image_paths]
         with torch.no_grad():
             # process data
+            # RGBA frames carry the mask in their alpha, the model only sees RGB
             seq = torch.from_numpy(
                 np.stack(
-                    seq_images, axis=0
+                    [np.asarray(img.convert('RGB')) for img in seq_images], axis=0
                 ).transpose(0, 3, 1, 2).astype(np.float32)/255.
             ).to(self.device)
             # Add noise
             noise = torch.empty_like(seq).normal_(
-                mean=0, std=self.noise_sigma).to(self.device)
+                mean=0, std=noise_sigma).to(self.device)
             seqn = seq + noise
-            noisestd = torch.FloatTensor([self.noise_sigma]).to(self.device)
+            noisestd = torch.FloatTensor([noise_sigma]).to(self.device)
             denframes = denoise_seq_fastdvdnet(
                 seq=seqn,
                 noise_std=noisestd,
                 temp_psz=self.temporal_size,
-                model_temporal=self.model
+                model_temporal=self.model,
+                batch_size=batch_size,
+                reuse_first_stage=reuse_first_stage,
+                tile_size=tile_size,
+                tile_overlap=tile_overlap
             )
         denframes = denframes.data.cpu().numpy()
         denframes = (denframes * 255.).clip(0, 255)\
             .astype(np.uint8).transpose(0, 2, 3, 1)
-        for o_img, p_img, p in zip(seq_images, denframes, image_paths):
-            p_img = Image.fromarray(p_img)
-            Image.blend(o_img, p_img, self.alpha).save(p)
+        self.write_back(seq_images, denframes, output_paths or image_paths, alpha, saver)
+
+    def process_chunked(
+            self, image_paths, alpha, noise_sigma, chunk_size,
+            batch_size=1, reuse_first_stage=True, tile_size=0, tile_overlap=32,
+            saver=None, output_paths=None):
+        """Denoises the sequence in overlapping temporal chunks.
+
+        Only the frames of the current chunk and the temporal_size // 2
+        neighbours on each side are in memory. The noise of every frame is
+        seeded by its index, so a frame shared by two chunks gets the same
+        noise in both, and frames past the ends are reflected like
+        denoise_seq_fastdvdnet does.
+        """
+        frame_n = len(image_paths)
+        output_paths = output_paths or image_paths
+        hws = self.temporal_size // 2
+        noise_seed = int(torch.randint(2**31 - 1, (1,)))
+        noisestd = torch.FloatTensor([noise_sigma]).to(self.device)
+        frames = {}  # index -> (original image, noisy tensor)
+
+        def load(i):
+            img = Image.open(image_paths[i])
+            img.load()  # the file is overwritten before the frame is dropped
+            seq = torch.from_numpy(
+                np.asarray(img.convert('RGB')).transpose(2, 0, 1)
+                .astype(np.float32)/255.
+            ).to(self.device)
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(noise_seed + i)
+            noise = torch.empty_like(seq).normal_(
+                mean=0, std=noise_sigma, generator=generator)
+            return img, seq + noise
+
+        for start in range(0, frame_n, chunk_size):
+            stop = min(start + chunk_size, frame_n)
+            indices = [
+                reflect_index(i, frame_n)
+                for i in range(start - hws, stop + hws)
+            ]
+            for i in indices:
+                if i not in frames:
+                    frames[i] = load(i)
+
+            with torch.no_grad():
+                seqp = torch.stack([frames[i][1] for i in indices], dim=0)
+                denframes = denoise_padded_seq_fastdvdnet(
+                    seqp=seqp,
+                    noise_std=noisestd,
+                    temp_psz=self.temporal_size,
+                    model_temporal=self.model,
+                    batch_size=batch_size,
+                    reuse_first_stage=reuse_first_stage,
+                    tile_size=tile_size,
+                    tile_overlap=tile_overlap
+                )
+            del seqp
+            denframes = denframes.data.cpu().numpy()
+            denframes = (denframes * 255.).clip(0, 255)\
+                .astype(np.uint8).transpose(0, 2, 3, 1)
+            self.write_back(
+                [frames[i][0] for i in range(start, stop)], denframes,
+                output_paths[start:stop], alpha, saver)
+
+            # the next chunk only needs the last hws frames of this one
+            for i in [i for i in frames if i < stop - hws]:
+                del frames[i]
+
+
+# loaded post processors, kept between runs
+_loaded_models: Dict[Tuple, FastDVDNet] = {}
+
+
+def get_fastdvdnet(
+        model_path=DEFAULT_MODEL_PATH, temporal_size=5,
+        device='cuda', precision='fp32', fused=False) -> FastDVDNet:
+    device = resolve_device(device)
+    # keyed on the precision that runs, a mode validated since is loaded on the next call
+    precision, reason = loaded_precision(model_path, precision, temporal_size, device, fused)
+    if reason is not None:
+        print(f'Warning: {reason}, using fp32')
+    key = (str(Path(model_path).absolute()), temporal_size, str(device), precision, fused)
+    if key not in _loaded_models:
+        _loaded_models[key] = FastDVDNet(
+            model_path=model_path, temporal_size=temporal_size,
+            device=device, precision=precision, fused=fused)
+    return _loaded_models[key]
+
+
+def unload_fastdvdnet():
+    if not _loaded_models:
+        return
+    print(f'Unloading {len(_loaded_models)} FastDVDNet model(s)')
+    _loaded_models.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
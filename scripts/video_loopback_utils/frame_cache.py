@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from PIL import Image
+
+from . import utils
+
+
+def image_nbytes(img: Image.Image) -> int:
+    width, height = img.size
+    return width * height * len(img.getbands())
+
+
+class DecodedFrameCache:
+    """Process-wide LRU cache of decoded and resized frames.
+
+    Entries are keyed on (path, mtime, target_size, resize_mode), so a
+    changed file or different settings never hit a stale frame. Cached
+    images are shared between all users and must not be modified in place.
+    """
+
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path, target_size):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:  # frames of a video stream have no file
+            mtime = None
+        return str(path), mtime, tuple(target_size), utils.resize_mode
+
+    def get(self, path, target_size, load: Callable[[], Image.Image]) -> Image.Image:
+        key = self.make_key(path, target_size)
+        with self._lock:
+            img = self._frames.get(key)
+            if img is not None:
+                self._frames.move_to_end(key)
+                return img
+
+        img = load()
+        nbytes = image_nbytes(img)
+        if nbytes > self.budget_bytes:
+            return img
+        with self._lock:
+            if key not in self._frames:
+                self._frames[key] = img
+                self.used_bytes += nbytes
+            self._evict()
+        return img
+
+    def _evict(self):
+        while self.used_bytes > self.budget_bytes and self._frames:
+            _, img = self._frames.popitem(last=False)
+            self.used_bytes -= image_nbytes(img)
+
+    def set_budget(self, budget_bytes):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.used_bytes = 0
+
+
+decoded_frame_cache = DecodedFrameCache()
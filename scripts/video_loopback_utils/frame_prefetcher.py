@@ -0,0 +1,39 @@
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict
+
+from PIL import Image
+
+
+class FramePrefetcher:
+    """Decodes and resizes upcoming frames on a worker pool.
+
+    ``get(i)`` returns frame ``i`` and schedules the ``depth`` frames after
+    it, so they are usually ready by the time the window reaches them.
+    Frames are requested in increasing order, anything behind the last
+    requested frame is dropped.
+    """
+
+    def __init__(
+            self, load: Callable[[int], Image.Image], frame_n: int,
+            executor: Executor, depth=4):
+        self.load = load
+        self.frame_n = frame_n
+        self.executor = executor
+        self.depth = depth
+        self._futures: Dict[int, Future] = {}
+
+    def get(self, i) -> Image.Image:
+        future = self._futures.pop(i, None)
+        for j in [j for j in self._futures if j < i]:
+            self._futures.pop(j).cancel()
+        for j in range(i + 1, min(i + 1 + self.depth, self.frame_n)):
+            if j not in self._futures:
+                self._futures[j] = self.executor.submit(self.load, j)
+        if future is None:
+            return self.load(i)
+        return future.result()
+
+    def cancel(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
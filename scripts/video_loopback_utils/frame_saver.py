@@ -0,0 +1,64 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+from PIL import Image
+
+from .utils import save_image, save_image_atomic
+
+
+class AsyncFrameSaver:
+    """Saves frames on a thread pool, behind the thread that drives SD.
+
+    At most ``max_pending`` frames wait to be written, ``submit`` blocks
+    when the queue is full. Each save keeps the retry behaviour of
+    ``utils.save_image``; failures are collected and raised by ``flush``,
+    which has to be called before anything reads the saved files.
+    With ``atomic`` frames are written through ``utils.save_image_atomic``.
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, atomic=False):
+        self._save_image = save_image_atomic if atomic else save_image
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='video_loopback_saver')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._errors: List[Tuple[Path, BaseException]] = []
+        self._lock = threading.Lock()
+
+    def _save(self, img: Image.Image, path: Path):
+        try:
+            self._save_image(img, path)
+        except BaseException as e:
+            with self._lock:
+                self._errors.append((path, e))
+        finally:
+            self._slots.release()
+
+    def submit(self, img: Image.Image, path):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._save, img, Path(path))
+        except BaseException:
+            self._slots.release()
+            raise
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(future)
+
+    def flush(self):
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            for path, e in errors:
+                print(f'Failed to save "{path}": {type(e).__name__} - {e}')
+            raise errors[0][1]
+
+    def shutdown(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,50 @@
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+
+class FrameStore:
+    """Keeps the output frames of a loop in memory for the next loop.
+
+    Frames are kept as decoded uint8 arrays until ``budget_bytes`` is used
+    up. The rest are spilled to disk: they are only read back from the
+    files written by ``save_current_output_image``.
+    Like ``FFmpegFrameReader`` it can be used as the ``image_path_list``
+    of a ``TemporalImageBlender``.
+    """
+
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self.paths: List[Path] = []
+        self._frames = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.paths[i]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def put(self, path, img: Image.Image):
+        path = Path(path)
+        self.paths.append(path)
+        if self.used_bytes >= self.budget_bytes:
+            return
+        frame = np.asarray(img)
+        if self.used_bytes + frame.nbytes <= self.budget_bytes:
+            self._frames[path] = frame
+            self.used_bytes += frame.nbytes
+
+    def open_image(self, path) -> Image.Image:
+        frame = self._frames.get(Path(path))
+        if frame is None:
+            return Image.open(path)
+        return Image.fromarray(frame)
+
+    def in_memory_n(self):
+        return len(self._frames)
@@ -0,0 +1,59 @@
+from bisect import bisect_right
+from typing import Any, List, Tuple
+
+
+def parse_ranges(text) -> List[List[Tuple[int, int]]]:
+    """'0-100,102-110;135-145' -> [[(0, 100), (102, 110)], [(135, 145)]]"""
+    sections_list = []
+    for section in text.split(';'):
+        intervals_list = []
+        for interval in section.split(','):
+            try:
+                start, end = map(int, interval.split('-'))
+            except ValueError:
+                raise ValueError(
+                    f'masa_control_active_range: "{interval.strip()}" is not a range like 0-100')
+            if start > end:
+                raise ValueError(
+                    f'masa_control_active_range: {start}-{end} ends before it starts')
+            intervals_list.append((start, end))
+        sections_list.append(intervals_list)
+    return sections_list
+
+
+class MasaCtrlRangePlan:
+    """Maps frame indices to MasaCtrl modes, resolved once per run.
+
+    Ranges are separated by ',' inside a section and sections by ';'. The
+    first frame of a section is logged, the rest of its ranges log and
+    reconstruct, every other frame is idle. Ranges must not overlap.
+    """
+
+    def __init__(self, text, logging_mode: Any, logrecon_mode: Any, idle_mode: Any):
+        self.idle_mode = idle_mode
+        ranges = []  # (start, end, mode)
+        for intervals_list in parse_ranges(text):
+            for i, (start, end) in enumerate(intervals_list):
+                if i == 0:
+                    ranges.append((start, start, logging_mode))
+                    if end > start:
+                        ranges.append((start + 1, end, logrecon_mode))
+                else:
+                    ranges.append((start, end, logrecon_mode))
+        ranges.sort(key=lambda r: r[0])
+        for prev, cur in zip(ranges, ranges[1:]):
+            if cur[0] <= prev[1]:
+                raise ValueError(
+                    f'masa_control_active_range: frame {cur[0]} is in more than one range')
+
+        self.starts = [r[0] for r in ranges]
+        self.ranges = ranges
+
+    def mode_at(self, frame):
+        i = bisect_right(self.starts, frame) - 1
+        if i >= 0 and frame <= self.ranges[i][1]:
+            return self.ranges[i][2]
+        return self.idle_mode
+
+    def is_active(self, frame) -> bool:
+        return self.mode_at(frame) != self.idle_mode
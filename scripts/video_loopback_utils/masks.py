@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+from .utils import resize_img, get_image_paths
+
+
+class MaskProvider:
+    """Builds the thresholded and resized inpainting masks of a run.
+
+    A mask directory is indexed once, and every mask is thresholded with a
+    lookup table, resized and cached, so asking for the mask of a frame
+    again is free. A single mask file is only processed once per run.
+    """
+
+    def __init__(
+            self, mask_dir='', mask_threshold=127,
+            target_size=(512, 512), cache_size=8):
+        self.mask_dir = Path(mask_dir) if mask_dir else None
+        self.target_size = target_size
+        self.lut = [255 if x > mask_threshold else 0 for x in range(256)]
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        self._mask_paths = None
+        if self.mask_dir:
+            if self.mask_dir.is_dir():
+                self._mask_paths = {p.name: p for p in get_image_paths(self.mask_dir)}
+            elif not self.mask_dir.is_file():
+                raise FileNotFoundError("mask not found")
+
+    def threshold(self, mask: Image.Image) -> Image.Image:
+        mask = mask.convert('L').point(self.lut)
+        if mask.size != self.target_size:
+            mask = resize_img(mask, self.target_size)
+        return mask
+
+    def file_mask(self, image_name) -> Optional[Image.Image]:
+        key = image_name if self._mask_paths is not None else None
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        mask = None
+        if self._mask_paths is None:
+            mask = self.threshold(Image.open(self.mask_dir))
+        elif image_name in self._mask_paths:
+            mask = self.threshold(Image.open(self._mask_paths[image_name]))
+        else:
+            print(f'Warning: "{self.mask_dir / image_name}" has no mask')
+
+        self._cache[key] = mask
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return mask
+
+    def alpha_mask(self, img: Image.Image, image_path) -> Optional[Image.Image]:
+        if 'RGBA' != img.mode:
+            print('current image mode: ', img.mode)
+            print(f'Warning: "{image_path}" has no alpha mask')
+            return None
+        return self.threshold(img.split()[-1])
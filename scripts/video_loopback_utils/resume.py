@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Tuple
+
+# written into a loop_N folder once the loop, its post processing and video are done
+LOOP_COMPLETE = '.loop_complete'
+# written into a loop_N folder once its frames have been post processed
+POST_PROCESSED = '.post_processed'
+# the post processed frames are written here before replacing the frames of the loop
+POST_PROCESS_DIR = '.post_process'
+
+# attributes of p recorded in the settings JSON
+PROCESSING_KEYS = (
+    'seed', 'subseed', 'subseed_strength', 'cfg_scale',
+    'prompt', 'negative_prompt', 'sampler_name', 'width', 'height',
+    'denoising_strength', 'batch_size', 'n_iter', 'steps', 'resize_mode',
+)
+
+
+class RunResume:
+    """An interrupted run, continued in its own directory.
+
+    Frames are saved atomically, so every ``%07d.png`` found in a loop folder
+    is complete. A loop is continued from its first missing frame, and loops
+    marked with ``LOOP_COMPLETE`` are skipped. A loop marked with
+    ``POST_PROCESSED`` has all its frames and is only encoded again.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = Path(run_dir)
+        self.timestamp = self.run_dir.name
+        settings_path = self.run_dir / f'{self.timestamp}.json'
+        if not settings_path.is_file():
+            raise ValueError(f'cannot resume, "{settings_path}" does not exist')
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            self.settings = json.load(f)
+
+    def run_args(self, run_args: dict) -> dict:
+        """run_args with the values recorded by the interrupted run.
+
+        Arguments added after that run keep their current values.
+        """
+        run_args = {
+            k: self.settings.get(k, v)
+            for k, v in run_args.items()
+        }
+        # the run directory may have been moved since
+        run_args['output_dir'] = str(self.run_dir.parent)
+        return run_args
+
+    def apply_to(self, p):
+        for key in PROCESSING_KEYS:
+            if self.settings.get(key) is not None:
+                setattr(p, key, self.settings[key])
+
+    @staticmethod
+    def loop_progress(loop_dir: Path, image_n) -> Tuple[int, bool]:
+        """Index of the first missing frame of a loop and whether it was completed."""
+        if (loop_dir / LOOP_COMPLETE).is_file():
+            return image_n, True
+        if (loop_dir / POST_PROCESSED).is_file():
+            return image_n, False
+        start_i = 0
+        while start_i < image_n and (loop_dir / f'{start_i:07d}.png').is_file():
+            start_i += 1
+        return start_i, False
+
+
+def post_process_once(loop_dir: Path, process: Callable[[Path], None]):
+    """Post processes the frames of a loop so an interruption never processes
+    a frame twice.
+
+    ``process(staging_dir)`` writes the processed frames into a staging
+    directory, which are then moved over the frames of the loop. If the run
+    stops while processing, the staging directory is discarded on resume;
+    if it stops while moving, the remaining frames are moved.
+    """
+    loop_dir = Path(loop_dir)
+    if (loop_dir / POST_PROCESSED).is_file():
+        return
+    staging_dir = loop_dir / POST_PROCESS_DIR
+    if not (staging_dir / POST_PROCESSED).is_file():
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir()
+        process(staging_dir)
+        (staging_dir / POST_PROCESSED).touch()
+    for name in os.listdir(staging_dir):
+        if not name.startswith('.'):
+            os.replace(staging_dir / name, loop_dir / name)
+    (loop_dir / POST_PROCESSED).touch()
+    shutil.rmtree(staging_dir)
+
@@ -0,0 +1,153 @@
+import numbers
+from types import CodeType
+from typing import Any, Callable, Dict, Optional
+
+# names a schedule can use to depend on the frame
+FRAME_NAMES = {'loop_i', 'image_i'}
+
+
+def _is_number(v) -> bool:
+    return isinstance(v, numbers.Real) and not isinstance(v, bool)
+
+
+def _is_whole(v) -> bool:
+    return _is_number(v) and float(v).is_integer()
+
+
+def _check_number(v, window):
+    return None if _is_number(v) else 'a number'
+
+
+def _check_whole(v, window):
+    return None if _is_whole(v) else 'a whole number'
+
+
+def _check_str(v, window):
+    return None if isinstance(v, str) else 'a string'
+
+
+def _check_batch_count(v, window):
+    if _is_whole(v):
+        return None
+    if isinstance(v, tuple) and len(v) == 2 and all(_is_whole(x) for x in v):
+        return None
+    return 'a batch count or a (batch_count, batch_size) tuple'
+
+
+def _check_temporal(v, window):
+    if isinstance(v, (list, tuple)) and len(v) == window and all(_is_number(x) for x in v):
+        return None
+    return f'a list of {window} numbers, as long as temporal_superimpose_alpha_list'
+
+
+def _check_callable(v, window):
+    return None if v is None or callable(v) else 'a function of the image or None'
+
+
+# schedule name -> check returning what was expected if the value is wrong
+SCHEDULE_CHECKS: Dict[str, Callable[[Any, int], Optional[str]]] = {
+    'subseed_strength_schedule': _check_number,
+    'denoising_schedule': _check_number,
+    'step_schedule': _check_whole,
+    'seed_schedule': _check_whole,
+    'subseed_schedule': _check_whole,
+    'cfg_schedule': _check_number,
+    'superimpose_alpha_schedule': _check_number,
+    'temporal_superimpose_schedule': _check_temporal,
+    'prompt_schedule': _check_str,
+    'negative_prompt_schedule': _check_str,
+    'batch_count_schedule': _check_batch_count,
+    'image_post_processing_schedule': _check_callable,
+}
+
+
+def code_names(code: CodeType) -> set:
+    """Global names used by code, including the lambdas defined in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= code_names(const)
+    return names
+
+
+class ScheduleTable:
+    """The schedules of a run, compiled and checked before the first frame.
+
+    Each expression is compiled once. Expressions that use neither loop_i nor
+    image_i are constant and evaluated once, the others each time ``values``
+    is called for a frame. All of them share one globals dict, on which
+    loop_i and image_i are set, so nothing is kept per frame. With
+    ``validate`` every frame is evaluated once up front without keeping the
+    values, and a ValueError names the schedule and frame of the first bad
+    one, before anything is generated.
+    """
+
+    def __init__(
+            self, schedules: Dict[str, str], schedule_args: dict,
+            loop_n: int, image_n: int, temporal_window: int, validate=True):
+        self.temporal_window = temporal_window
+        self.sources: Dict[str, str] = {}
+        self.constant: Dict[str, Any] = {}
+        self.per_frame: Dict[str, CodeType] = {}
+        self._globals = dict(schedule_args)
+
+        for name, source in schedules.items():
+            if not source:
+                continue
+            try:
+                code = compile(source, f'<{name}>', 'eval')
+            except SyntaxError as e:
+                raise ValueError(f'{name} is not a valid expression: {e}') from e
+            self.sources[name] = source
+            if code_names(code) & FRAME_NAMES:
+                self.per_frame[name] = code
+            else:
+                self.constant[name] = self._evaluate(name, code, 0, 0)
+
+        if validate:
+            for loop_i in range(loop_n):
+                for image_i in range(image_n):
+                    self.values(loop_i, image_i)
+
+    def _evaluate(self, name, code, loop_i, image_i):
+        # indices start from 1 in the schedules
+        self._globals['loop_i'] = loop_i + 1
+        self._globals['image_i'] = image_i + 1
+        where = f'{name} at loop_i={loop_i + 1}, image_i={image_i + 1}'
+        try:
+            value = eval(code, self._globals)
+        except Exception as e:
+            raise ValueError(f'{where} failed: {type(e).__name__} - {e}') from e
+        expected = SCHEDULE_CHECKS[name](value, self.temporal_window)
+        if expected is not None:
+            raise ValueError(f'{where} should be {expected}, got {value!r}')
+        return value
+
+    def values(self, loop_i, image_i) -> Dict[str, Any]:
+        """Values of the non-empty schedules for a frame, indices from 0.
+
+        Functions returned here see the indices of this frame until values
+        is called for another one.
+        """
+        values = dict(self.constant)
+        for name, code in self.per_frame.items():
+            values[name] = self._evaluate(name, code, loop_i, image_i)
+        return values
+
+    def to_json(self) -> dict:
+        def jsonable(v):
+            if isinstance(v, (str, bool)) or v is None:
+                return v
+            if isinstance(v, numbers.Integral):
+                return int(v)
+            if isinstance(v, numbers.Real):
+                return float(v)
+            if isinstance(v, (list, tuple)):
+                return [jsonable(x) for x in v]
+            if callable(v):
+                return '<function>'
+            return repr(v)
+        return {
+            'constant': {k: jsonable(v) for k, v in self.constant.items()},
+            'per_frame': {k: self.sources[k] for k in self.per_frame},
+        }
@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+SHARD_ROLES = ('off', 'coordinator', 'worker')
+
+# seconds between two looks at the queue
+POLL_SECONDS = 2
+# seconds between two refreshes of a claim while its job runs
+HEARTBEAT_SECONDS = 30
+# a claim not refreshed for this long belongs to a worker that is gone
+STALE_CLAIM_SECONDS = 600
+
+
+def split_range(start_i, end_i, shard_size) -> List[Tuple[int, int]]:
+    """Contiguous [start, end) frame ranges of at most shard_size frames."""
+    shard_size = max(int(shard_size), 1)
+    return [(i, min(i + shard_size, end_i)) for i in range(start_i, end_i, shard_size)]
+
+
+class ShardJob:
+    """Frames [start_i, end_i) of a loop of the run in run_dir.
+
+    ``frames`` holds the (seed, subseed, n_iter, batch_size) of every frame,
+    as the coordinator would have used them running the loop by itself.
+    """
+
+    def __init__(self, name, data: dict, queue: 'ShardQueue'):
+        self.name = name
+        self.run_dir = Path(data['run_dir'])
+        self.loop_i = data['loop_i']
+        self.start_i = data['start_i']
+        self.end_i = data['end_i']
+        self.frames = [tuple(x) for x in data['frames']]
+        self.queue = queue
+
+    def heartbeat(self):
+        # the mtime of the claim tells the coordinator the worker is alive
+        try:
+            os.utime(self.queue.claimed_dir / self.name)
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def keep_alive(self, interval=HEARTBEAT_SECONDS):
+        """Refreshes the claim from a thread while the job runs, however long
+        a single frame takes."""
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(interval):
+                self.heartbeat()
+
+        thread = threading.Thread(target=beat, name='video_loopback_heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+
+class ShardQueue:
+    """Frame ranges exchanged between webui instances through a directory.
+
+    A job is a JSON file moving from ``pending`` to ``claimed`` and then to
+    ``done`` or ``failed``. Every move is an ``os.replace`` or ``os.rename``
+    on the same file system, so a job is claimed by exactly one instance.
+    Jobs are named after the run, loop and first frame, and claimed in
+    that order.
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = Path(queue_dir)
+        self.pending_dir = self.queue_dir / 'pending'
+        self.claimed_dir = self.queue_dir / 'claimed'
+        self.done_dir = self.queue_dir / 'done'
+        self.failed_dir = self.queue_dir / 'failed'
+        self.stop_file = self.queue_dir / 'STOP'
+        for d in (self.pending_dir, self.claimed_dir, self.done_dir, self.failed_dir):
+            d.mkdir(parents=True, exist_ok=True)
+
+    def put(self, run_dir, loop_i, start_i, end_i, frames) -> str:
+        run_dir = Path(run_dir)
+        name = f'{run_dir.name}-loop_{loop_i + 1:04d}-{start_i:07d}.json'
+        data = {
+            'run_dir': str(run_dir.absolute()),
+            'loop_i': loop_i,
+            'start_i': start_i,
+            'end_i': end_i,
+            'frames': [list(x) for x in frames],
+        }
+        tmp_path = self.queue_dir / f'.{name}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        for d in (self.done_dir, self.failed_dir):
+            (d / name).unlink(missing_ok=True)
+        os.replace(tmp_path, self.pending_dir / name)
+        return name
+
+    def claim(self, prefix='') -> Optional[ShardJob]:
+        for name in sorted(os.listdir(self.pending_dir)):
+            if not name.startswith(prefix) or not name.endswith('.json'):
+                continue
+            try:
+                os.rename(self.pending_dir / name, self.claimed_dir / name)
+            except FileNotFoundError:
+                continue  # claimed by another instance
+            with open(self.claimed_dir / name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            job = ShardJob(name, data, self)
+            job.heartbeat()
+            return job
+        return None
+
+    def _move_claim(self, job: ShardJob, target_dir: Path):
+        try:
+            os.replace(self.claimed_dir / job.name, target_dir / job.name)
+        except FileNotFoundError:
+            pass  # requeued as stale or cancelled meanwhile
+
+    def complete(self, job: ShardJob):
+        self._move_claim(job, self.done_dir)
+
+    def release(self, job: ShardJob):
+        """Puts an unfinished job back for another instance."""
+        self._move_claim(job, self.pending_dir)
+
+    def fail(self, job: ShardJob, error: BaseException):
+        try:
+            with open(self.claimed_dir / job.name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        data['error'] = f'{type(error).__name__}: {error}'
+        with open(self.claimed_dir / job.name, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        self._move_claim(job, self.failed_dir)
+
+    def requeue_stale(self, timeout=STALE_CLAIM_SECONDS):
+        now = time.time()
+        for name in os.listdir(self.claimed_dir):
+            path = self.claimed_dir / name
+            try:
+                if now - path.stat().st_mtime > timeout:
+                    os.rename(path, self.pending_dir / name)
+                    print(f'{name} was not refreshed for {timeout}s, requeued')
+            except FileNotFoundError:
+                pass
+
+    def finished(self, names: Iterable[str]) -> bool:
+        """Whether every job is done, raises if one of them failed."""
+        names = list(names)
+        for name in names:
+            failed = self.failed_dir / name
+            if failed.is_file():
+                with open(failed, 'r', encoding='utf-8') as f:
+                    error = json.load(f).get('error')
+                raise RuntimeError(f'shard {name} failed: {error}')
+        return all((self.done_dir / name).is_file() for name in names)
+
+    def cancel(self, names: Iterable[str]):
+        """Withdraws the jobs nobody has claimed yet."""
+        for name in names:
+            (self.pending_dir / name).unlink(missing_ok=True)
+
+    def drain(self, names: Iterable[str]):
+        """Withdraws the pending jobs and waits until the claimed ones are
+        done, failed or released, so nobody writes their frames any more."""
+        names = list(names)
+        while True:
+            self.cancel(names)
+            if not any((self.claimed_dir / name).exists() for name in names):
+                return
+            self.requeue_stale()
+            time.sleep(POLL_SECONDS)
+
+    def stopped(self) -> bool:
+        # workers leave once a STOP file is put in the queue directory
+        return self.stop_file.exists()
@@ -0,0 +1,127 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+_disabled = nullcontext()
+
+
+def percentile(values: List[float], q) -> float:
+    """Nearest-rank percentile."""
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': max(values),
+    }
+
+
+class StageTimer:
+    """Wall time spent in each stage of a run, per frame and per loop.
+
+    ``stage(name)`` is a context manager. While disabled it returns a shared
+    no-op context, so instrumented code only pays for an attribute check.
+    Time measured between ``begin_frame`` and ``end_frame`` belongs to that
+    frame, including stages run on other threads such as prefetching, the
+    rest belongs to the loop set by ``begin_loop``.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.start(False)
+
+    def start(self, enabled: bool):
+        self.enabled = enabled
+        self.frames: List[dict] = []
+        # loop_i -> stage -> seconds of every frame
+        self.frame_stages: Dict[int, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+        # loop_i -> stage -> seconds of the stages outside the frames
+        self.loop_stages: Dict[int, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+        self._frame: Optional[Tuple[int, int]] = None
+        self._frame_stages: Dict[str, float] = defaultdict(float)
+        self._frame_start = 0.0
+        self._loop_i = 0
+
+    def stage(self, name):
+        if not self.enabled:
+            return _disabled
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                if self._frame is not None:
+                    self._frame_stages[name] += elapsed
+                else:
+                    self.loop_stages[self._loop_i][name].append(elapsed)
+
+    def begin_loop(self, loop_i):
+        self._loop_i = loop_i
+
+    def begin_frame(self, loop_i, image_i):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._loop_i = loop_i
+            self._frame = (loop_i, image_i)
+            self._frame_stages = defaultdict(float)
+            self._frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if not self.enabled or self._frame is None:
+            return
+        with self._lock:
+            loop_i, image_i = self._frame
+            stages = dict(self._frame_stages)
+            stages['frame'] = time.perf_counter() - self._frame_start
+            self.frames.append({'loop_i': loop_i + 1, 'image_i': image_i + 1, 'stages': stages})
+            for name, elapsed in stages.items():
+                self.frame_stages[loop_i][name].append(elapsed)
+            self._frame = None
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                'frames': list(self.frames),
+                'loops': [
+                    {
+                        'loop_i': loop_i + 1,
+                        'per_frame': {
+                            name: summarize(v)
+                            for name, v in self.frame_stages.get(loop_i, {}).items()
+                        },
+                        'loop': {
+                            name: summarize(v)
+                            for name, v in self.loop_stages.get(loop_i, {}).items()
+                        },
+                    }
+                    for loop_i in sorted(set(self.frame_stages) | set(self.loop_stages))
+                ],
+            }
+
+    def write(self, path: Path):
+        if not self.enabled:
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, indent=4)
+
+
+# timings.timer.start(enabled) at the beginning of a run
+timer = StageTimer()
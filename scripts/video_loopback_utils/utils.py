@@ -1,12 +1,14 @@
-import os, datetime, imghdr
+import os, datetime, threading, time
 from pathlib import Path
 from typing import List, Tuple, Iterable
 from PIL import Image
 
-from modules import shared
 from modules import images
 
+from . import blending
+
 resize_mode = 0  # utils.resize_mode = p.resize_mode
+blend_engine = 'numpy'  # utils.blend_engine = 'numpy' or 'PIL'
 
 
 def resize_img(img, target_size):
@@ -18,8 +20,9 @@ def resize_img(img, target_size):
 def make_video(
         input_dir, output_filename,
         frame_rate=12, input_format='%07d.png'):
+    # -y: a resumed run encodes over the video of the interrupted one
     os.system(
-        f"ffmpeg -r {frame_rate} "
+        f"ffmpeg -y -r {frame_rate} "
         f' -i "{Path(input_dir) / input_format}" '
         " -c:v libx264 "
         # " -c:v mpeg4 "
@@ -30,14 +33,101 @@ def make_video(
     )
 
 
+def save_image(img: Image.Image, path, max_retries=3, retry_interval=5, format=None):
+    for i in range(max_retries):
+        try:
+            img.save(path, format=format)
+            break
+        except (OSError, FileNotFoundError) as e:
+            # Transport endpoint is not connected or FileNotFoundError
+            print(f"Exception occurred: {type(e).__name__} - {str(e)}")
+            if i < max_retries - 1:  # wait for a while unless this is the last try
+                time.sleep(retry_interval)
+            else:
+                raise
+
+
+def save_image_atomic(img: Image.Image, path, max_retries=3, retry_interval=5):
+    """Saves next to path and renames over it, so path is never half written."""
+    path = Path(path)
+    # dotfiles are skipped by get_image_paths
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    save_image(img, tmp_path, max_retries, retry_interval,
+               format=Image.registered_extensions()[path.suffix.lower()])
+    os.replace(tmp_path, path)
+
+
+IMAGE_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tif', '.tiff', '.gif'
+}
+
+
+def sniff_image(filename) -> bool:
+    with open(filename, 'rb') as f:
+        head = f.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return head.startswith((
+        b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'BM',
+        b'GIF87a', b'GIF89a', b'II*\x00', b'MM\x00*'
+    ))
+
+
 def is_image(filename) -> bool:
     filename = Path(filename)
-    return filename.is_file() and imghdr.what(filename) is not None
+    return filename.is_file() and sniff_image(filename)
+
+
+class FrameDirectoryIndex:
+    """Lists the image files of directories.
 
+    Files are classified by extension, and optionally by their first bytes.
+    Results are cached until the modification time of the directory changes,
+    so the input and reference directories are only listed once per run.
+    """
 
-def get_image_paths(input_dir: Path) -> List[Path]:
-    path_list: List[Path] = shared.listfiles(input_dir)  # sorted
-    return [Path(p) for p in path_list if is_image(p)]
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory, sniff=False) -> List[Path]:
+        directory = Path(directory)
+        key = (str(directory.absolute()), sniff)
+        mtime = directory.stat().st_mtime_ns
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1])
+
+        # same order as shared.listfiles
+        with os.scandir(directory) as it:
+            names = sorted(
+                (
+                    entry.name for entry in it
+                    if not entry.name.startswith('.')
+                    and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+                    and entry.is_file()
+                ),
+                key=str.lower
+            )
+        paths = [directory / name for name in names]
+        if sniff:
+            paths = [p for p in paths if sniff_image(p)]
+
+        with self._lock:
+            self._cache[key] = (mtime, paths)
+        return list(paths)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+frame_index = FrameDirectoryIndex()
+
+
+def get_image_paths(input_dir: Path, sniff=False) -> List[Path]:
+    return frame_index.get(input_dir, sniff=sniff)
 
 
 def get_prompt_for_images(
@@ -58,6 +148,12 @@ def get_prompt_for_images(
 
 
 def blend_average(img_iter: Iterable[Image.Image]) -> Image.Image:
+    if blend_engine == 'numpy':
+        return blending.blend_average(img_iter)
+    return blend_average_pil(img_iter)
+
+
+def blend_average_pil(img_iter: Iterable[Image.Image]) -> Image.Image:
     img_iter = iter(img_iter)
     new_img = next(img_iter)
     for i, img in enumerate(img_iter, 1):
@@ -0,0 +1,214 @@
+import json
+import subprocess
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Tuple
+
+from PIL import Image
+
+
+def probe_video(filename) -> Tuple[int, int, int]:
+    """Returns (width, height, frame_count) of the first video stream.
+
+    Packets are counted instead of decoded frames, which only needs a pass
+    over the container and is fast even for long clips.
+    """
+    out = subprocess.run(
+        [
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-count_packets',
+            '-show_entries',
+            'stream=width,height,nb_read_packets:stream_tags=rotate'
+            ':stream_side_data=rotation',
+            '-of', 'json', str(filename)
+        ],
+        check=True, capture_output=True, text=True
+    ).stdout
+    stream = json.loads(out)['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+
+    # ffmpeg auto-rotates on decode, so the piped frames are transposed
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+
+    return width, height, int(stream['nb_read_packets'])
+
+
+class FFmpegFrameReader:
+    """Decodes a video file through an ffmpeg rawvideo pipe.
+
+    It behaves like the list of paths that extracting the video to
+    ``frames_dir/%07d.png`` would have produced, but nothing is written:
+    ``open_image`` returns the decoded frame for one of these paths.
+    Frames are decoded in order and the last ``cache_size`` are kept,
+    seeking backwards past them restarts the decoder.
+    """
+
+    def __init__(
+            self, video_path, frames_dir,
+            extract_nth_frame=1, max_frames=None, cache_size=16):
+        self.video_path = Path(video_path)
+        self.width, self.height, source_n = probe_video(self.video_path)
+        self.frame_bytes = self.width * self.height * 3
+        self.extract_nth_frame = max(int(extract_nth_frame), 1)
+
+        frame_n = -(-source_n // self.extract_nth_frame)
+        if max_frames is not None:
+            frame_n = min(frame_n, int(max_frames))
+        self.paths: List[Path] = [
+            Path(frames_dir) / f'{i * self.extract_nth_frame + 1:07d}.png'
+            for i in range(frame_n)
+        ]
+        self._index = {p: i for i, p in enumerate(self.paths)}
+
+        self.cache_size = max(int(cache_size), 1)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._proc = None
+        self._source_i = 0  # index of the next frame in the pipe
+        self._last_frame = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.paths[i]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def _start(self):
+        self.close()
+        self._proc = subprocess.Popen(
+            [
+                'ffmpeg', '-nostdin', '-v', 'error',
+                '-i', str(self.video_path),
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'
+            ],
+            stdout=subprocess.PIPE,
+            bufsize=self.frame_bytes
+        )
+        self._source_i = 0
+        self._last_frame = None
+
+    def _read_source_frame(self):
+        data = self._proc.stdout.read(self.frame_bytes)
+        self._source_i += 1
+        if len(data) < self.frame_bytes:
+            return None
+        return Image.frombytes('RGB', (self.width, self.height), data)
+
+    def _decode(self, i) -> Image.Image:
+        source_i = i * self.extract_nth_frame
+        if self._proc is None or source_i < self._source_i:
+            self._start()
+        img = None
+        while self._source_i <= source_i:
+            wanted = self._source_i % self.extract_nth_frame == 0
+            if not wanted:
+                self._proc.stdout.read(self.frame_bytes)
+                self._source_i += 1
+                continue
+            img = self._read_source_frame()
+            if img is None:
+                # ffprobe's packet count can be slightly off for some codecs
+                print(f'Warning: "{self.video_path}" ended before frame '
+                      f'{source_i + 1}, repeating the last frame')
+                img = self._last_frame
+                break
+            self._last_frame = img
+            self._cache[(self._source_i - 1) // self.extract_nth_frame] = img
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        if img is None:
+            raise RuntimeError(f'could not decode any frame from "{self.video_path}"')
+        return img
+
+    def open_image(self, path) -> Image.Image:
+        i = self._index[Path(path)]
+        with self._lock:
+            img = self._cache.get(i)
+            if img is None:
+                img = self._decode(i)
+        return img.copy()
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdout.close()
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+
+class FFmpegVideoWriter:
+    """Encodes frames into a video as they are produced.
+
+    An ffmpeg process is kept open and fed raw RGB frames over its stdin,
+    so the video is finished as soon as the last frame is written. The
+    encoder settings are the same as ``utils.make_video``.
+    If ffmpeg cannot be started or dies, the following frames are dropped
+    and ``close`` returns False, so the caller can encode the saved frames.
+    """
+
+    def __init__(self, output_filename, frame_rate=12):
+        self.output_filename = Path(output_filename)
+        self.frame_rate = frame_rate
+        self.size = None
+        self.frame_n = 0
+        self.failed = False
+        self._proc = None
+
+    def _start(self, size):
+        self.size = size
+        width, height = size
+        self._proc = subprocess.Popen(
+            [
+                'ffmpeg', '-nostdin', '-y', '-v', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                '-s', f'{width}x{height}', '-r', str(self.frame_rate),
+                '-i', '-',
+                '-c:v', 'libx264', '-qp', '0', '-pix_fmt', 'yuv420p',
+                str(self.output_filename)
+            ],
+            stdin=subprocess.PIPE
+        )
+
+    def write(self, img: Image.Image):
+        if self.failed:
+            return
+        if img.size != self.size and self.size is not None:
+            img = img.resize(self.size, Image.LANCZOS)
+        try:
+            if self._proc is None:
+                self._start(img.size)
+            self._proc.stdin.write(img.convert('RGB').tobytes())
+        except OSError as e:  # BrokenPipeError when ffmpeg has exited
+            print(f'Warning: cannot write "{self.output_filename}": {type(e).__name__} - {e}')
+            self.failed = True
+            return
+        self.frame_n += 1
+
+    def close(self) -> bool:
+        """Finishes the video, returns whether a complete file was written."""
+        if self._proc is None:
+            return False
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            self.failed = True
+        returncode = self._proc.wait()
+        self._proc = None
+        if returncode != 0:
+            print(f'Warning: ffmpeg exited with {returncode} '
+                  f'while writing "{self.output_filename}"')
+        return returncode == 0 and not self.failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()